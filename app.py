@@ -1,54 +1,23 @@
 import streamlit as st
 import requests
 import pandas as pd
-import pytz
 import datetime
 import io
-from streamlit_autorefresh import st_autorefresh
-import ftplib
 import io
 import time
 import datetime
 import os
-from free_gift_handler import FreeGiftReceiver, get_streaming_server_info, update_free_gift_master, gift_queue
-
-
-def upload_csv_to_ftp(filename: str, csv_buffer: io.BytesIO):
-    """Secretsに登録されたFTP設定を使ってCSVをアップロード"""
-    ftp_info = st.secrets["ftp"]
-    try:
-        ftp = ftplib.FTP(ftp_info["host"])
-        ftp.login(ftp_info["user"], ftp_info["password"])
-        ftp.cwd("/rokudouji.net/mksoul/showroom_onlives_logs")
-
-        # アップロード
-        csv_buffer.seek(0)
-        ftp.storbinary(f"STOR {filename}", csv_buffer)
-
-        # --- 古いファイル削除（48時間以上前） ---
-        file_list = []
-        ftp.retrlines("LIST", file_list.append)
-        now = datetime.datetime.now()
-        for entry in file_list:
-            parts = entry.split(maxsplit=8)
-            if len(parts) < 9:
-                continue
-            name = parts[-1]
-            if not name.endswith(".csv"):
-                continue
-            # 日時文字列が含まれる形式なら抽出
-            try:
-                time_str = name.split("_")[-1].replace(".csv", "")
-                file_dt = datetime.datetime.strptime(time_str, "%Y%m%d_%H%M%S")
-                if (now - file_dt).total_seconds() > 48 * 3600:
-                    ftp.delete(name)
-            except Exception:
-                continue
-
-        ftp.quit()
-        st.success(f"✅ FTPに保存完了: {filename}")
-    except Exception as e:
-        st.error(f"FTP保存中にエラー: {e}")
+from collections import OrderedDict
+from free_gift_handler import create_receiver, get_streaming_server_info, gift_queue, ingest_raw_batch
+from showroom_api import (
+    JST, api_get, row_time, format_jst, gift_fields,
+    onlives_cache, gift_catalog_cache, get_and_update_log, get_gift_list, get_free_gift_master, get_fan_list,
+)
+from ftp_writer import (
+    ftp_uploader, upload_named_df_to_ftp, df_to_parquet_bytes, create_segmented_exports, build_gift_df,
+)
+from collector import POLL_INTERVAL, load_snapshot, load_live_snapshot, snapshot_path, last_heartbeat, snapshot_stale_sec
+from event_store import CommentLog, EventLog, RoomLog, GiftTally, JournalTail, LOG_KINDS, tally_groups, open_room_logs
 
 
 def auto_backup_if_needed():
@@ -98,17 +67,14 @@ def save_log_to_ftp(log_type: str):
 
         # ===== コメントログ処理 =====
         if log_type == "comment":
-            filtered_comments = [
-                log for log in st.session_state.comment_log
-                if not any(keyword in log.get('name', '') or keyword in log.get('comment', '')
-                           for keyword in SYSTEM_COMMENT_KEYWORDS)
-            ]
+            # システムコメントは取り込み時に振り分け済み（comment_log.system_comments）
+            filtered_comments = list(st.session_state.comment_log)
             if not filtered_comments:
                 return
 
             comment_df = pd.DataFrame(filtered_comments)
-            comment_df['created_at'] = pd.to_datetime(comment_df['created_at'], unit='s') \
-                .dt.tz_localize('UTC').dt.tz_convert(JST).dt.strftime("%Y-%m-%d %H:%M:%S")
+            # 取り込み時に計算済みの日本時間を使う
+            comment_df['created_at'] = [row_time(log) for log in filtered_comments]
             comment_df['user_id'] = [log.get('user_id', 'N/A') for log in filtered_comments]
             comment_df = comment_df.rename(columns={
                 'name': 'ユーザー名',
@@ -117,46 +83,223 @@ def save_log_to_ftp(log_type: str):
                 'user_id': 'ユーザーID'
             })
             cols = ['コメント時間', 'ユーザー名', 'コメント内容', 'ユーザーID']
-            buf = io.BytesIO()
-            comment_df[cols].to_csv(buf, index=False, encoding='utf-8-sig')
-            buf.seek(0)
             filename = f"comment_log_{room}_{timestamp}.csv"
-            upload_csv_to_ftp(filename, buf)
+            # CSV（と同名の Parquet）をアップロード
+            upload_named_df_to_ftp(filename, comment_df[cols])
 
         # ===== ギフトログ処理 =====
         elif log_type == "gift":
             if not st.session_state.gift_log:
                 return
-            gift_df = pd.DataFrame(st.session_state.gift_log)
-            gift_df['created_at'] = pd.to_datetime(gift_df['created_at'], unit='s') \
-                .dt.tz_localize('UTC').dt.tz_convert(JST).dt.strftime("%Y-%m-%d %H:%M:%S")
-
-            if st.session_state.gift_list_map:
-                gift_info_df = pd.DataFrame.from_dict(st.session_state.gift_list_map, orient='index')
-                gift_info_df.index = gift_info_df.index.astype(str)
-                gift_df['gift_id'] = gift_df['gift_id'].astype(str)
-                gift_df = gift_df.set_index('gift_id') \
-                    .join(gift_info_df, on='gift_id', lsuffix='_user_data', rsuffix='_gift_info') \
-                    .reset_index()
-
-            gift_df = gift_df.rename(columns={
-                'name_user_data': 'ユーザー名',
-                'name_gift_info': 'ギフト名',
-                'num': '個数',
-                'point': 'ポイント',
-                'created_at': 'ギフト時間',
-                'user_id': 'ユーザーID'
-            })
+            # ギフト名・ポイントは取り込み時に付与済みなので、ギフトリストとの結合はしない
+            gift_df = build_gift_df(st.session_state.gift_log, st.session_state.gift_list_map)
             cols = ['ギフト時間', 'ユーザー名', 'ギフト名', '個数', 'ポイント', 'ユーザーID']
-            buf = io.BytesIO()
-            gift_df[cols].to_csv(buf, index=False, encoding='utf-8-sig')
-            buf.seek(0)
             filename = f"gift_log_{room}_{timestamp}.csv"
-            upload_csv_to_ftp(filename, buf)
+            upload_named_df_to_ftp(filename, gift_df[cols])
     except Exception as e:
         st.error(f"ログ保存中にエラー: {e}")
 
 
+# --- ダッシュボードの各列は新しい順に DASHBOARD_PAGE_SIZE 件ずつ表示する ---
+# ログ全件を毎回送ると、件数が増えるほど再描画のたびにブラウザへ送る要素が増えるため
+DASHBOARD_PAGE_SIZE = 100
+
+
+def visible_rows(log, column_key):
+    """表示中のページ分（新しい順の先頭から）の (イベントID, 行)"""
+    limit = st.session_state.get(f"{column_key}_pages", 1) * DASHBOARD_PAGE_SIZE
+    if isinstance(log, EventLog):
+        return log.newest(limit)
+    # 閲覧専用モード（スナップショットのリスト）はイベントIDが無いのでキャッシュしない
+    return [(None, row) for row in log[:limit]]
+
+
+def more_rows_button(log, column_key):
+    """表示しきれていない行があれば「さらに表示」ボタンを出す"""
+    pages = st.session_state.get(f"{column_key}_pages", 1)
+    if len(log) > pages * DASHBOARD_PAGE_SIZE:
+        if st.button(f"さらに{DASHBOARD_PAGE_SIZE}件表示（全{len(log)}件）", key=f"{column_key}_more", use_container_width=True):
+            st.session_state[f"{column_key}_pages"] = pages + 1
+            # ダッシュボードのフラグメント内のボタンなので、そのフラグメントだけを描き直す
+            st.rerun(scope="fragment")
+
+
+# --- ダッシュボードの行HTMLのキャッシュ ---
+# 取り込み後に行の内容は変わらないので、組み立てたHTMLをイベントIDごとに覚えておき、
+# 再描画では新しく届いた行だけを組み立てる（セッションごと・LRUで件数の上限あり）
+ROW_HTML_CACHE_SIZE = 2000
+
+
+class RowHtmlCache:
+    def __init__(self, max_size=ROW_HTML_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        if key is None:
+            return None
+        html = self.entries.get(key)
+        if html is not None:
+            self.entries.move_to_end(key)
+        return html
+
+    def put(self, key, html):
+        if key is None:
+            return
+        self.entries[key] = html
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+if "row_html_cache" not in st.session_state:
+    st.session_state.row_html_cache = RowHtmlCache()
+
+
+# --- ダッシュボードの列ごとの組み立て済みHTML ---
+# 配信中は DASHBOARD_TICK_SEC ごとに再実行されるが、新しいログが届いていない更新では
+# 前回組み立てた列のHTMLをそのまま送り、行の取り出しや結合をやり直さない
+DASHBOARD_COLUMNS = ["comment", "gift", "free_gift", "system_msg"]
+
+if "dashboard_html" not in st.session_state:
+    st.session_state.dashboard_html = {}
+
+
+def dashboard_version():
+    """ダッシュボードの表示内容が変わったかを見分ける目印（各ログの追加件数・ギフトリスト・表示ページ数）"""
+    return data_version(
+        st.session_state.comment_log, st.session_state.gift_log,
+        st.session_state.free_gift_log, st.session_state.system_msg_log, st.session_state.gift_list_map,
+    ) + tuple(st.session_state.get(f"{column_key}_pages", 1) for column_key in DASHBOARD_COLUMNS)
+
+
+def dashboard_html(column_key, version):
+    """前回の更新から変わっていなければ組み立て済みの列のHTML、変わっていれば None"""
+    cached = st.session_state.dashboard_html.get(column_key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    return None
+
+
+# --- ギフトの集計表（ユーザー単位でギフト合算 / ユーザー単位の総貢献Pt順） ---
+# ギフトログに追加するたびに更新される累計（GiftTally）から作るので、手間はログ全件ではなく
+# 「ユーザー × ギフト」の組の数に比例する。
+
+def gift_tally(log):
+    """ログの累計。閲覧専用モード（スナップショットのリスト）はその場で集計する"""
+    return log.tally if isinstance(log, EventLog) else GiftTally(log)
+
+
+def resolve_special_gift(gift_id, pair):
+    """
+    スペシャルギフトは取り込み時に付けた名前・ポイントを使う。付いていないギフトだけギフトリストから引き、
+    それでも分からないギフトは集計しない
+    """
+    if pair["gift_name"] is not None:
+        return pair["gift_name"], int(pair["point"] or 0)
+    gift_info = st.session_state.gift_list_map.get(gift_id)
+    if not gift_info:
+        return None
+    return gift_info.get("name"), int(gift_info.get("point", 0))
+
+
+def special_gift_rows(log):
+    """一覧表用のスペシャルギフト行。ギフト名・ポイントが付いていない行だけギフトリストから補う"""
+    gift_map = st.session_state.gift_list_map
+    rows = []
+    for row in log:
+        if row.get("gift_name") is None:
+            gift_name, point, image = gift_fields(row, gift_map)
+            row = dict(row, gift_name=gift_name, point=point, image=image)
+        rows.append(row)
+    return rows
+
+
+def resolve_free_gift(gift_id, pair):
+    """無償ギフトは取り込み時にマスターから付けた名前・ポイントを使う"""
+    return pair["gift_name"], int(pair["point"] or 0)
+
+
+def gift_sum_df(groups):
+    """ユーザー単位でギフト合算集計（最新ギフト時間の新しい順）"""
+    return pd.DataFrame([
+        {
+            '最新ギフト時間': format_jst(group['created_at']),
+            'ユーザー名': group['name'],
+            'ギフト名': group['gift_name'],
+            '合計個数': group['num'],
+            'ポイント': group['point'],
+            '合計Pt（※単純合計値）': group['num'] * group['point'],
+        }
+        for group in sorted(groups, key=lambda g: g['created_at'], reverse=True)
+    ], columns=['最新ギフト時間', 'ユーザー名', 'ギフト名', '合計個数', 'ポイント', '合計Pt（※単純合計値）'])
+
+
+def user_ranking_df(groups):
+    """ユーザー単位で集計（総貢献Pt順）。ユーザー名・総貢献Ptはユーザーごとの先頭行にだけ表示する"""
+    totals = {}
+    for group in groups:
+        totals[group['user_id']] = totals.get(group['user_id'], 0) + group['num'] * group['point']
+    ordered = sorted(groups, key=lambda g: (-totals[g['user_id']], g['user_id'], -g['num'] * g['point']))
+
+    rows = []
+    prev_id = None
+    for group in ordered:
+        is_first = group['user_id'] != prev_id
+        rows.append({
+            'ユーザー名': group['name'] if is_first else '',
+            'ギフト名': group['gift_name'], '合計個数': group['num'], 'ポイント': group['point'],
+            'ギフト単位Pt': group['num'] * group['point'],
+            '総貢献Pt（※単純合計値）': totals[group['user_id']] if is_first else ''
+        })
+        prev_id = group['user_id']
+    return pd.DataFrame(rows, columns=['ユーザー名', 'ギフト名', '合計個数', 'ポイント', 'ギフト単位Pt', '総貢献Pt（※単純合計値）'])
+
+
+def data_version(*sources):
+    """ログ・リストの中身が変わったかを見分ける目印（EventLog は追加件数、それ以外は実体と件数）"""
+    return tuple(
+        (source.serial, source.added) if isinstance(source, EventLog) else (id(source), len(source))
+        for source in sources
+    )
+
+
+def cached_tables(key, version, build):
+    """
+    ログ詳細の表（DataFrame・CSVのバイト列等）を、元データの version（data_version）が変わった時だけ build() で作り直す。
+    配信中でも新しいログが届いていなければ、ログ詳細の再実行では組み立て直さない
+    """
+    cache = st.session_state.setdefault("log_details_cache", {})
+    cached = cache.get(key)
+    if cached is None or cached[0] != version:
+        cached = cache[key] = (version, build())
+    return cached[1]
+
+
+def csv_bytes(df):
+    """ダウンロード用の utf-8-sig のCSV"""
+    buf = io.BytesIO()
+    df.to_csv(buf, index=False, encoding='utf-8-sig')
+    return buf.getvalue()
+
+
+def parquet_download_button(label, df, file_name, key, version):
+    """
+    CSVと同じ表を型付きの Parquet でダウンロードできるようにする（pyarrow が無い環境では表示しない）。
+    Parquet への変換は重いので、元データの version（data_version）が変わった時だけやり直す
+    """
+    cache = st.session_state.setdefault("parquet_cache", {})
+    cached = cache.get(key)
+    if cached is not None and cached[0] == version:
+        data = cached[1]
+    else:
+        try:
+            data = df_to_parquet_bytes(df)
+        except ImportError:
+            return
+        cache[key] = (version, data)
+    st.download_button(label, data, file_name, "application/vnd.apache.parquet", key=key)
+
+
 
 # ページ設定
 st.set_page_config(
@@ -166,17 +309,6 @@ st.set_page_config(
 )
 
 # 定数
-HEADERS = {
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-    "Accept-Language": "ja-JP,ja;q=0.9,en-US;q=0.8,en;q=0.7",
-}
-JST = pytz.timezone('Asia/Tokyo')
-ONLIVES_API_URL = "https://www.showroom-live.com/api/live/onlives"
-COMMENT_API_URL = "https://www.showroom-live.com/api/live/comment_log"
-GIFT_API_URL = "https://www.showroom-live.com/api/live/gift_log"
-GIFT_LIST_API_URL = "https://www.showroom-live.com/api/live/gift_list"
-FAN_LIST_API_URL = "https://www.showroom-live.com/api/active_fan/users"
-SYSTEM_COMMENT_KEYWORDS = ["SHOWROOM Management", "Earn weekly glittery rewards!", "ウィークリーグリッター特典獲得中！", "SHOWROOM運営"]
 DEFAULT_AVATAR = "https://static.showroom-live.com/image/avatar/default_avatar.png"
 ROOM_LIST_URL = "https://mksoul-pro.com/showroom/file/room_list.csv"
 
@@ -297,9 +429,9 @@ if "room_id" not in st.session_state:
 if "is_tracking" not in st.session_state:
     st.session_state.is_tracking = False
 if "comment_log" not in st.session_state:
-    st.session_state.comment_log = []
+    st.session_state.comment_log = CommentLog()
 if "gift_log" not in st.session_state:
-    st.session_state.gift_log = []
+    st.session_state.gift_log = RoomLog("gift")
 if "fan_list" not in st.session_state:
     st.session_state.fan_list = []
 if "gift_list_map" not in st.session_state:
@@ -311,7 +443,9 @@ if 'total_fan_count' not in st.session_state:
 
 # --- 無償ギフト用に追加 ---
 if "free_gift_log" not in st.session_state:
-    st.session_state.free_gift_log = []
+    st.session_state.free_gift_log = EventLog("free_gift")
+if "system_msg_log" not in st.session_state:
+    st.session_state.system_msg_log = EventLog("system_msg")
 if "raw_free_gift_queue" not in st.session_state:
     st.session_state.raw_free_gift_queue = []
 if "free_gift_master" not in st.session_state:
@@ -320,129 +454,6 @@ if "ws_receiver" not in st.session_state:
     st.session_state.ws_receiver = None
 # -----------------------
 
-# --- API連携関数 ---
-
-def get_onlives_rooms():
-    onlives = {}
-    try:
-        response = requests.get(ONLIVES_API_URL, headers=HEADERS, timeout=5)
-        response.raise_for_status()
-        data = response.json()
-        all_lives = []
-        if isinstance(data, dict):
-            if 'onlives' in data and isinstance(data['onlives'], list):
-                for genre_group in data['onlives']:
-                    if 'lives' in genre_group and isinstance(genre_group['lives'], list):
-                        all_lives.extend(genre_group['lives'])
-            for live_type in ['official_lives', 'talent_lives', 'amateur_lives']:
-                if live_type in data and isinstance(data.get(live_type), list):
-                    all_lives.extend(data[live_type])
-        for room in all_lives:
-            room_id = None
-            if isinstance(room, dict):
-                room_id = room.get('room_id')
-                if room_id is None and 'live_info' in room and isinstance(room['live_info'], dict):
-                    room_id = room['live_info'].get('room_id')
-                if room_id is None and 'room' in room and isinstance(room['room'], dict):
-                    room_id = room['room'].get('room_id')
-            if room_id:
-                onlives[int(room_id)] = room
-    except requests.exceptions.RequestException as e:
-        st.error(f"配信情報取得中にエラーが発生しました: {e}")
-    except (ValueError, AttributeError):
-        st.error("配信情報のJSONデコードまたは解析に失敗しました。")
-    return onlives
-
-def get_and_update_log(log_type, room_id):
-    api_url = COMMENT_API_URL if log_type == "comment" else GIFT_API_URL
-    url = f"{api_url}?room_id={room_id}"
-    try:
-        response = requests.get(url, headers=HEADERS, timeout=5)
-        response.raise_for_status()
-        new_log = response.json().get(f'{log_type}_log', [])
-        existing_cache = st.session_state[f"{log_type}_log"]
-        existing_log_keys = {(log.get('created_at'), log.get('name')) for log in existing_cache}
-        for log in new_log:
-            log_key = (log.get('created_at'), log.get('name'))
-            if log_key not in existing_log_keys:
-                existing_cache.append(log)
-                existing_log_keys.add(log_key)
-        existing_cache.sort(key=lambda x: x.get('created_at', 0), reverse=True)
-        return existing_cache
-    except requests.exceptions.RequestException:
-        st.warning(f"ルームID {room_id} の{log_type}ログ取得中にエラーが発生しました。配信中か確認してください。")
-        return st.session_state.get(f"{log_type}_log", [])
-
-def get_gift_list(room_id, force_update=False):
-    """
-    ギフトリストを取得しキャッシュする。
-    force_update=True、または未知のギフトIDに遭遇した際に再取得を行う。
-    """
-    # キャッシュがあり、強制更新でない場合はそのまま返す
-    if st.session_state.gift_list_map and not force_update:
-        return st.session_state.gift_list_map
-
-    url = f"{GIFT_LIST_API_URL}?room_id={room_id}"
-    try:
-        response = requests.get(url, headers=HEADERS, timeout=5)
-        response.raise_for_status()
-        data = response.json()
-        
-        new_map = {}
-        # すべてのカテゴリ（normal, special, enquete, seasonal等）を網羅的に走査
-        for category_key in data.keys():
-            category_items = data.get(category_key, [])
-            if isinstance(category_items, list):
-                for gift in category_items:
-                    gid = str(gift.get('gift_id'))
-                    try:
-                        p = int(gift.get('point', 0))
-                    except (ValueError, TypeError):
-                        p = 0
-                    
-                    new_map[gid] = {
-                        'name': gift.get('gift_name', 'N/A'),
-                        'point': p,
-                        'image': gift.get('image', ''),
-                        'free': gift.get('free', False)
-                    }
-        
-        st.session_state.gift_list_map = new_map
-        return new_map
-    except Exception as e:
-        print(f"Gift List API Error: {e}")
-        return st.session_state.get('gift_list_map', {})
-
-
-def get_fan_list(room_id):
-    fan_list = []
-    offset = 0
-    limit = 50
-    current_ym = datetime.datetime.now(JST).strftime("%Y%m")
-    total_user_count = 0
-    while True:
-        url = f"{FAN_LIST_API_URL}?room_id={room_id}&ym={current_ym}&offset={offset}&limit={limit}"
-        try:
-            response = requests.get(url, headers=HEADERS, timeout=5)
-            response.raise_for_status()
-            data = response.json()
-            users = data.get("users", [])
-            if offset == 0 and "total_user_count" in data:
-                total_user_count = data["total_user_count"]
-            if not users:
-                break
-            for user in users:
-                if user.get('level', 0) < 10:
-                    return fan_list, total_user_count
-                fan_list.append(user)
-            offset += len(users)
-            if len(users) < limit:
-                break
-        except requests.exceptions.RequestException:
-            st.warning(f"ルームID {room_id} のファンリスト取得中にエラーが発生しました。")
-            break
-    return fan_list, total_user_count
-
 # --- ルームリスト取得関数 ---
 def get_room_list():
     try:
@@ -454,28 +465,9 @@ def get_room_list():
 
 def update_free_gift_master(room_id):
     """ギフトリストAPIから無償ギフト(free=True)のみを抽出し、セッション状態のマスターを更新する"""
-    url = f"https://www.showroom-live.com/api/live/gift_list?room_id={room_id}"
-    try:
-        response = requests.get(url, headers=HEADERS, timeout=5)
-        response.raise_for_status()
-        data = response.json()
-        
-        # normal などのリストの中にギフト情報が入っている
-        new_master = {}
-        # normal, special, enquete など複数のカテゴリを走査
-        for category in data.values():
-            if isinstance(category, list):
-                for gift in category:
-                    # フリー かつ point が 1 のものだけをマスターに登録する
-                    if gift.get("free") == True and gift.get("point") == 1:
-                        new_master[gift.get("gift_id")] = {
-                            "name": gift.get("gift_name"),
-                            "point": gift.get("point", 0),
-                            "image": gift.get("image")
-                        }
+    new_master = get_free_gift_master(room_id)
+    if new_master is not None:
         st.session_state.free_gift_master = new_master
-    except Exception as e:
-        st.error(f"ギフトリストの取得に失敗しました: {e}")
 
 
 # --- UI構築 ---
@@ -548,26 +540,48 @@ if st.button("トラッキング開始", key="start_button"):
             # エラー時は状態を更新せず、メッセージだけ出す（下の停止ボタンは非活性のまま残る）
             st.error("指定されたルームIDが見つからないか、認証されていないルームIDか、現在配信中ではありません。")
         else:
-            # 配信サーバー情報を取得
-            streaming_info = get_streaming_server_info(input_room_id)
-            
-            if not streaming_info:
+            # collector.py が今まさに収集中のルームなら、その出力を読み取り専用で表示する
+            # （配信終了後や停止したコレクターのスナップショットしか無ければ、ここで収集する）
+            collector_snapshot = load_live_snapshot(input_room_id)
+            # 配信サーバー情報を取得（閲覧専用モードでは受信機を起動しないので不要）
+            streaming_info = None if collector_snapshot else get_streaming_server_info(input_room_id)
+
+            if collector_snapshot is not None:
+                if st.session_state.get("ws_receiver"):
+                    try:
+                        st.session_state.ws_receiver.stop()
+                    except:
+                        pass
+                st.session_state.ws_receiver = None
+                st.session_state.is_tracking = True
+                st.session_state.viewer_mode = True
+                st.session_state.room_id = input_room_id
+                st.rerun()
+            elif not streaming_info:
                 # サーバー情報が取れない（配信中でない）場合もエラー表示のみ
                 st.error("指定されたルームIDが見つからないか、認証されていないルームIDか、現在配信中ではありません。")
             else:
                 # --- 正常系：ここから下は配信中であることが確定した場合のみ実行 ---
                 st.session_state.is_tracking = True
+                st.session_state.viewer_mode = False
                 st.session_state.room_id = input_room_id
                 
-                # --- 既存ログの初期化 ---
-                st.session_state.comment_log = []
-                st.session_state.gift_log = []
+                # --- 既存ログの初期化（同じ配信のジャーナルがあればそこから復元） ---
+                if st.session_state.get("journal"):
+                    st.session_state.journal.close()
+                logs, st.session_state.journal = open_room_logs(input_room_id, streaming_info.get("live_id"))
+                st.session_state.comment_log = logs["comment"]
+                st.session_state.gift_log = logs["gift"]
                 st.session_state.gift_list_map = {}
                 st.session_state.fan_list = []
                 st.session_state.total_fan_count = 0
-                st.session_state.free_gift_log = []
+                st.session_state.free_gift_log = logs["free_gift"]
                 st.session_state.raw_free_gift_queue = []
-                st.session_state.system_msg_log = []
+                st.session_state.system_msg_log = logs["system_msg"]
+                st.session_state.exports = create_segmented_exports(input_room_id, lambda: st.session_state.gift_list_map, logs)
+                for column_key in ["comment", "gift", "free_gift", "system_msg"]:
+                    st.session_state.pop(f"{column_key}_pages", None)
+                st.session_state.pop("last_polled_at", None)
                 
                 # 1. 無償ギフトマスターの取得
                 update_free_gift_master(input_room_id)
@@ -579,7 +593,7 @@ if st.button("トラッキング開始", key="start_button"):
                     except:
                         pass
                 
-                receiver = FreeGiftReceiver(
+                receiver = create_receiver(
                     room_id=input_room_id,
                     host=streaming_info["host"],
                     key=streaming_info["key"]
@@ -593,7 +607,8 @@ if st.button("トラッキング開始", key="start_button"):
         st.error("ルームIDを入力してください。")
 
 if st.button("トラッキング停止", key="stop_button", disabled=not st.session_state.is_tracking):
-    if st.session_state.is_tracking:
+    # 閲覧専用モードでは保存は collector.py 側が行う
+    if st.session_state.is_tracking and not st.session_state.get("viewer_mode"):
         save_log_to_ftp("comment")
         save_log_to_ftp("gift")
         save_log_to_ftp("free_gift")
@@ -605,298 +620,158 @@ if st.button("トラッキング停止", key="stop_button", disabled=not st.sess
     # st.rerun()  # ← ここをコメントアウトして即時リセットを防ぐ
 
 
-if st.session_state.is_tracking or st.session_state.get("room_id"):
-    onlives_data = get_onlives_rooms()
-    target_room_info = onlives_data.get(int(st.session_state.room_id)) if st.session_state.room_id.isdigit() else None
-
-    # --- 配信終了検知と自動保存処理 ---
-    # インデントを一段（半角スペース4つ）に統一しています
-    is_live_now = int(st.session_state.room_id) in onlives_data
-
-    if not is_live_now:
-        # st.warning("📡 配信が終了しました。全ログを最終保存します。")
-        st.info("📡 配信の終了を確認しました。未保存のログを含め、最終データを保存します。")
-
-        # 1. コメントログ保存
-        if st.session_state.comment_log:
-            comment_df = pd.DataFrame([
-                {
-                    "コメント時間": datetime.datetime.fromtimestamp(log.get("created_at", 0), JST).strftime("%Y-%m-%d %H:%M:%S"),
-                    "ユーザー名": log.get("name", ""),
-                    "コメント内容": log.get("comment", ""),
-                    "ユーザーID": log.get("user_id", "")
-                }
-                for log in st.session_state.comment_log
-                if not any(keyword in log.get("name", "") or keyword in log.get("comment", "") for keyword in SYSTEM_COMMENT_KEYWORDS)
-            ])
-            buf = io.BytesIO()
-            comment_df.to_csv(buf, index=False, encoding="utf-8-sig")
-            upload_csv_to_ftp(f"comment_log_{st.session_state.room_id}_{datetime.datetime.now(JST).strftime('%Y%m%d_%H%M%S')}.csv", buf)
-
-        # 2. 有償ギフトログ保存
-        if st.session_state.gift_log:
-            gift_df = pd.DataFrame([
-                {
-                    "ギフト時間": datetime.datetime.fromtimestamp(log.get("created_at", 0), JST).strftime("%Y-%m-%d %H:%M:%S"),
-                    "ユーザー名": log.get("name", ""),
-                    "ギフト名": st.session_state.gift_list_map.get(str(log.get("gift_id")), {}).get("name", ""),
-                    "個数": log.get("num", ""),
-                    "ポイント": st.session_state.gift_list_map.get(str(log.get("gift_id")), {}).get("point", 0),
-                    "ユーザーID": log.get("user_id", "")
-                }
-                for log in st.session_state.gift_log
-            ])
-            buf = io.BytesIO()
-            gift_df.to_csv(buf, index=False, encoding="utf-8-sig")
-            upload_csv_to_ftp(f"gift_log_{st.session_state.room_id}_{datetime.datetime.now(JST).strftime('%Y%m%d_%H%M%S')}.csv", buf)
-
-        # 3. 無償ギフトログ保存（追加分）
-        if st.session_state.free_gift_log:
-            free_gift_df = pd.DataFrame([
-                {
-                    "ギフト時間": datetime.datetime.fromtimestamp(log.get("created_at", 0), JST).strftime("%Y-%m-%d %H:%M:%S"),
-                    "ユーザー名": log.get("name", ""),
-                    "ギフト名": log.get("gift_name", ""),
-                    "個数": log.get("num", ""),
-                    "ポイント": log.get("point", 0),
-                    "ユーザーID": log.get("user_id", "")
-                }
-                for log in st.session_state.free_gift_log
-            ])
-            buf = io.BytesIO()
-            free_gift_df.to_csv(buf, index=False, encoding="utf-8-sig")
-            upload_csv_to_ftp(f"free_gift_log_{st.session_state.room_id}_{datetime.datetime.now(JST).strftime('%Y%m%d_%H%M%S')}.csv", buf)
-
-        # 4. システムメッセージログ保存（追加）
-        if st.session_state.system_msg_log:
-            system_msg_df = pd.DataFrame([
-                {
-                    "時間": datetime.datetime.fromtimestamp(log.get("created_at", 0), JST).strftime("%Y-%m-%d %H:%M:%S"),
-                    "メッセージ": log.get("message", ""),
-                    "ユーザーID": log.get("user_id", "")
-                }
-                for log in st.session_state.system_msg_log
-            ])
-            buf = io.BytesIO()
-            system_msg_df.to_csv(buf, index=False, encoding="utf-8-sig")
-            upload_csv_to_ftp(f"system_msg_log_{st.session_state.room_id}_{datetime.datetime.now(JST).strftime('%Y%m%d_%H%M%S')}.csv", buf)
-
-        # 配信が終了しても、表示用のフラグを「停止」にせず、警告を出すだけにする
-        # st.session_state.is_tracking = False  # 消去またはコメントアウト
-        # st.warning("📡 配信が終了しました。ログを最終保存しました。このまま振り返りが可能です。")
-        # st.success("✅ 最終保存が完了しました。このままデータの確認や手動ダウンロードが可能です。")
-        st.success("✅ 最終保存が完了しました。自動更新を停止し、現在のログを保持しています。このままデータの確認やダウンロードが可能です。")
-        # st.rerun()  # 消去またはコメントアウト
-
+# --- 閲覧専用モード：collector.py のスナップショットの読み込み ---
+# ログの行はスナップショットではなく collector.py のジャーナルから、新しく書かれた分だけ読む（JournalTail）。
+# 読み込んだログはセッションの間使い続けるので、収集する場合と同じく行HTMLのキャッシュや累計が効く
+VIEWER_SNAPSHOT_KEYS = ["gift_list_map", "fan_list", "total_fan_count"]
 
-    if target_room_info or st.session_state.get("room_id"):
-        room_id = st.session_state.room_id
 
-        # ルーム名取得
-        try:
-            prof = requests.get(f"https://www.showroom-live.com/api/room/profile?room_id={room_id}", headers=HEADERS, timeout=5).json()
-            room_name = prof.get("room_name", f"ルームID {room_id}")
-        except Exception:
-            room_name = f"ルームID {room_id}"
-        # URLキー取得
-        room_url_key = prof.get("room_url_key", "")
-        room_url = f"https://www.showroom-live.com/r/{room_url_key}" if room_url_key else f"https://www.showroom-live.com/room/profile?room_id={room_id}"
-        link_html = f'<a href="{room_url}" target="_blank" style="font-weight:bold; text-decoration:underline; color:inherit;">{room_name}</a>'        
-        # 配信状態によってメッセージを切り替える
-        if is_live_now:
-            # 配信中（緑色）
-            st.markdown(f'<div class="tracking-success">📡 {link_html} の配信をトラッキング中です。</div>', unsafe_allow_html=True)
+def snapshot_mtime(room_id):
+    try:
+        return os.path.getmtime(snapshot_path(room_id))
+    except OSError:
+        return None
+
+
+def load_viewer_snapshot(room_id):
+    """スナップショットをセッション状態に読み込む。存在しない・古すぎる場合は None"""
+    st.session_state.viewer_snapshot_mtime = snapshot_mtime(room_id)
+    snapshot = load_snapshot(room_id)
+    if snapshot is not None:
+        for key in VIEWER_SNAPSHOT_KEYS:
+            st.session_state[key] = snapshot[key]
+        journal_path = snapshot.get("journal")
+        if journal_path:
+            tail = st.session_state.get("viewer_tail")
+            if tail is None or tail.path != journal_path:
+                st.session_state.viewer_tail = JournalTail(journal_path)
+            load_viewer_rows()
         else:
-            # 💡 ここを直接書き込みから「クラス指定」に変更します
-            st.markdown(f'<div class="tracking-info">🏁 {link_html} の配信は終了しました。</div>', unsafe_allow_html=True)
-
-        # 配信中の時だけ自動更新し、新しいログを取得しにいく
+            # ジャーナルの無いコレクター（live_id 不明等）はスナップショットにログ全体が入っている
+            st.session_state.viewer_tail = None
+            for kind in LOG_KINDS:
+                st.session_state[f"{kind}_log"] = snapshot[f"{kind}_log"]
+    st.session_state.viewer_is_live = bool(snapshot and snapshot["is_live"])
+    return snapshot
+
+
+def load_viewer_rows():
+    """ジャーナルに新しく書かれた行だけをログに取り込む"""
+    tail = st.session_state.get("viewer_tail")
+    if tail is None:
+        return
+    tail.poll()
+    for kind in LOG_KINDS:
+        st.session_state[f"{kind}_log"] = tail.logs[kind]
+
+
+def viewer_snapshot_changed(room_id):
+    """スナップショットが書き換えられたか、配信中なのにハートビートが止まって古くなったか"""
+    mtime = snapshot_mtime(room_id)
+    if mtime != st.session_state.get("viewer_snapshot_mtime"):
+        return True
+    heartbeat = last_heartbeat(room_id) or mtime
+    return bool(st.session_state.get("viewer_is_live") and heartbeat and time.time() - heartbeat > snapshot_stale_sec(room_id))
+
+
+# --- ログの取り込み ---
+# WebSocket（無償ギフト・システムMSG）のキューはダッシュボードの更新のたびに取り出し、
+# コメント・スペシャルギフト・ギフト一覧・ファンリストのAPIは POLL_INTERVAL 秒ごとにだけ取得する
+def ingest_live_events(is_live_now):
+    room_id = st.session_state.room_id
+    # 切断中に reap_abandoned_receivers() 等で止められた受信機は、セッションに戻ってきたら再開する
+    receiver = st.session_state.get("ws_receiver")
+    if is_live_now and receiver is not None and not receiver.is_running:
+        receiver.start()
+    if time.time() - st.session_state.get("last_polled_at", 0) >= POLL_INTERVAL:
+        st.session_state.last_polled_at = time.time()
         if is_live_now:
-            st_autorefresh(interval=10000, limit=None, key="dashboard_refresh")
-            st.session_state.comment_log = get_and_update_log("comment", st.session_state.room_id)
-            st.session_state.gift_log = get_and_update_log("gift", st.session_state.room_id)
-        else:
-            # 💡 ここにあった st.info を削除（またはコメントアウト）します
-            # st.info("配信が終了したため、自動更新を停止しました。現在のログを保持しています。")
-            pass
-
-        import math
-
-        # コメントログ自動保存
-        prev_comment_count = st.session_state.get("prev_comment_count", 0)
-        current_comment_count = len(st.session_state.comment_log)
-
-        # 💡 修正後の保存しきい値: prev_comment_countを次の100の倍数に丸めた値
-        # 例: prev_countが105の場合、次の保存しきい値は200
-        # 例: prev_countが100の場合、次の保存しきい値は200
-        next_save_threshold = math.ceil((prev_comment_count + 1) / 100) * 100
-
-        # 🌟 条件判定: 現在の総数が次の100の倍数のしきい値以上になったら保存
-        if current_comment_count >= next_save_threshold:
-            if current_comment_count > 0:
-                comment_df = pd.DataFrame([
-                    # ... DataFrame生成の処理は省略 ...
-                    # 既存のコードのまま、全ログをDataFrameに変換
-                    {
-                        "コメント時間": datetime.datetime.fromtimestamp(log.get("created_at", 0), JST).strftime("%Y-%m-%d %H:%M:%S"),
-                        "ユーザー名": log.get("name", ""),
-                        "コメント内容": log.get("comment", ""),
-                        "ユーザーID": log.get("user_id", "")
-                    }
-                    for log in st.session_state.comment_log
-                    if not any(keyword in log.get("name", "") or keyword in log.get("comment", "") for keyword in SYSTEM_COMMENT_KEYWORDS)
-                ])
-                
-                buf = io.BytesIO()
-                comment_df.to_csv(buf, index=False, encoding="utf-8-sig")
-                upload_csv_to_ftp(f"comment_log_{st.session_state.room_id}_{datetime.datetime.now(JST).strftime('%Y%m%d_%H%M%S')}.csv", buf)
-                
-                # 🌟 変更点: 次に保存すべき件数 (100の倍数) に更新する
-                # ここで `current_comment_count` ではなく `next_save_threshold` を使用
-                st.session_state.prev_comment_count = next_save_threshold
-
-        import math # mathモジュールをインポートしてください
-
-        # ギフトログ自動保存
-        prev_gift_count = st.session_state.get("prev_gift_count", 0)
-        current_gift_count = len(st.session_state.gift_log)
-
-        # 🌟 修正点1: 次に保存を実行すべき100の倍数を計算
-        # 例: prev_gift_countが105の場合、next_save_thresholdは200になる
-        next_save_threshold = math.ceil((prev_gift_count + 1) / 100) * 100
-
-        # 🌟 修正点2: 条件判定を次の100の倍数に達したかどうかに変更
-        if current_gift_count >= next_save_threshold:
-            if current_gift_count > 0:
-                gift_df = pd.DataFrame([
-                    {
-                        "ギフト時間": datetime.datetime.fromtimestamp(log.get("created_at", 0), JST).strftime("%Y-%m-%d %H:%M:%S"),
-                        "ユーザー名": log.get("name", ""),
-                        "ギフト名": st.session_state.gift_list_map.get(str(log.get("gift_id")), {}).get("name", ""),
-                        "個数": log.get("num", ""),
-                        "ポイント": st.session_state.gift_list_map.get(str(log.get("gift_id")), {}).get("point", 0),
-                        "ユーザーID": log.get("user_id", "")
-                    }
-                    for log in st.session_state.gift_log
-                ])
-                
-                buf = io.BytesIO()
-                gift_df.to_csv(buf, index=False, encoding="utf-8-sig")
-                upload_csv_to_ftp(f"gift_log_{st.session_state.room_id}_{datetime.datetime.now(JST).strftime('%Y%m%d_%H%M%S')}.csv", buf)
-                
-                # 🌟 修正点3: prev_gift_countを、実際に保存したときの総数ではなく、
-                # 次の保存しきい値（100の倍数）に強制的に更新する
-                st.session_state.prev_gift_count = next_save_threshold
-
-        #auto_backup_if_needed()
-        st.session_state.gift_list_map = get_gift_list(st.session_state.room_id)
-        fan_list, total_fan_count = get_fan_list(st.session_state.room_id)
+            st.session_state.comment_log = get_and_update_log("comment", room_id, st.session_state.comment_log)
+            st.session_state.gift_log = get_and_update_log("gift", room_id, st.session_state.gift_log)
+        st.session_state.gift_list_map = get_gift_list(room_id) or st.session_state.gift_list_map
+        fan_list, total_fan_count = get_fan_list(room_id)
         st.session_state.fan_list = fan_list
         st.session_state.total_fan_count = total_fan_count
 
-        # --- 無償ギフト・システムMSG：キューからデータを取り出してログに変換 ---
-        while not gift_queue.empty():
-            try:
-                raw_data = gift_queue.get_nowait()
-                
-                # t の判定（文字列に変換して比較するのが最も安全です）
-                m_type = str(raw_data.get("t", ""))
-
-                # --- ✅ A. システムメッセージ (t: 18) の処理 ---
-                if m_type == "18":
-                    # time.time() は使わず、datetime で安全にタイムスタンプを取得
-                    ts = raw_data.get("created_at") or int(datetime.datetime.now().timestamp())
-                    new_sys_entry = {
-                        "created_at": ts,
-                        "message": raw_data.get("m", ""),
-                        "user_id": raw_data.get("u")
-                    }
-                    st.session_state.system_msg_log.insert(0, new_sys_entry)
-                    # st.session_state.system_msg_log = st.session_state.system_msg_log[:200]
-
-                # --- 🎁 B. 無償ギフト (t: 2) の処理 ---
-                elif m_type == "2":
-                    g_id = raw_data.get("g")
-                    if g_id is None:
-                        continue
-                    
-                    # ギフトマスターとの照合
-                    master = st.session_state.get("free_gift_master", {})
-                    # IDが数値でも文字列でも見つけられるように検索
-                    gift_info = master.get(str(g_id)) or master.get(g_id)
-                    
-                    if not gift_info:
-                        # マスターにない（有償ギフトなど）場合はスキップ
-                        continue
-                    
-                    ts = raw_data.get("created_at") or int(datetime.datetime.now().timestamp())
-                    new_entry = {
-                        "created_at": ts,
-                        "user_id": raw_data.get("u"),
-                        "name": raw_data.get("ac"),
-                        "avatar_id": raw_data.get("av"),
-                        "gift_id": str(g_id),
-                        "gift_name": gift_info.get("name"),
-                        "point": gift_info.get("point", 1),
-                        "num": raw_data.get("n", 1),
-                        "image": gift_info.get("image", "")
-                    }
-                    st.session_state.free_gift_log.insert(0, new_entry)
-                    # st.session_state.free_gift_log = st.session_state.free_gift_log[:200]
-
-            except Exception as e:
-                # ここで print しておけば、アプリを止めずにコンソールで原因を確認できます
-                print(f"Loop Error: {e}")
-                continue
-
-        # 最後に時間順にソート（念のため）
-        st.session_state.free_gift_log.sort(key=lambda x: x["created_at"], reverse=True)
-
-        # --- 無償ギフトログ自動保存 (100件ごと) ---
-        prev_free_gift_count = st.session_state.get("prev_free_gift_count", 0)
-        current_free_gift_count = len(st.session_state.free_gift_log)
-        next_free_save_threshold = math.ceil((prev_free_gift_count + 1) / 100) * 100
-
-        if current_free_gift_count >= next_free_save_threshold:
-            if current_free_gift_count > 0:
-                free_gift_df = pd.DataFrame([
-                    {
-                        "ギフト時間": datetime.datetime.fromtimestamp(log.get("created_at", 0), JST).strftime("%Y-%m-%d %H:%M:%S"),
-                        "ユーザー名": log.get("name", ""),
-                        "ギフト名": log.get("gift_name", ""),
-                        "個数": log.get("num", ""),
-                        "ポイント": log.get("point", 0),
-                        "ユーザーID": log.get("user_id", "")
-                    }
-                    for log in st.session_state.free_gift_log
-                ])
-                buf = io.BytesIO()
-                free_gift_df.to_csv(buf, index=False, encoding="utf-8-sig")
-                upload_csv_to_ftp(f"free_gift_log_{st.session_state.room_id}_{datetime.datetime.now(JST).strftime('%Y%m%d_%H%M%S')}.csv", buf)
-                st.session_state.prev_free_gift_count = next_free_save_threshold
+    # --- 無償ギフト・システムMSG：キューからまとめて取り出してログに変換 ---
+    # 1回の更新で取り出すのは DRAIN_BATCH_SIZE 件まで（残りは次の更新で取り出す）
+    ingest_raw_batch(
+        gift_queue.drain(),
+        st.session_state.get("free_gift_master", {}),
+        st.session_state.free_gift_log,
+        st.session_state.system_msg_log,
+    )
 
-        st.markdown("---")
-        st.markdown("<h2 style='font-size:2em;'>📊 リアルタイムダッシュボード</h2>", unsafe_allow_html=True)
-        st.markdown(f"**最終更新日時 (日本時間): {datetime.datetime.now(JST).strftime('%Y-%m-%d %H:%M:%S')}**")
-        st.markdown(f"<p style='font-size:12px; color:#a1a1a1;'>※約10秒ごとに自動更新されます。</p>", unsafe_allow_html=True)
-
-        # カラムを4つに分割
-        col_comment, col_gift, col_free_gift, col_fan = st.columns(4)
-
-        with col_comment:
-            st.markdown("###### 📝 コメント")
-            with st.container(border=True, height=500):
-                filtered_comments = [
-                    log for log in st.session_state.comment_log 
-                    if not any(keyword in log.get('name', '') or keyword in log.get('comment', '') for keyword in SYSTEM_COMMENT_KEYWORDS)
-                ]
-                if filtered_comments:
-                    # 💡 表示制限コントロール (制限したい場合は [:100] を有効にする)
-                    display_comments = filtered_comments # [:100]
-                    for log in display_comments:
+    # 今回の更新で取り込んだ行をまとめてジャーナルに確定する
+    if st.session_state.get("journal"):
+        st.session_state.journal.sync()
+
+    # --- コメント・ギフト・無償ギフト・システムMSGの自動保存 (100件ごと) ---
+    # 毎回全件を出し直さず、前回保存以降に増えた行だけをセグメントとして保存する
+    if st.session_state.get("exports"):
+        for log_type in ["comment", "gift", "free_gift", "system_msg"]:
+            st.session_state.exports[log_type].checkpoint_if_due(st.session_state[f"{log_type}_log"])
+
+
+# --- リアルタイムダッシュボード ---
+# 配信中はこの部分だけを DASHBOARD_TICK_SEC ごとに再実行する（st.fragment）。
+# アプリ全体を再実行しないので、ログ詳細のタブやボタン類は組み立て直さずに新しいログを反映できる
+DASHBOARD_TICK_SEC = 1
+
+
+def live_dashboard(collect_here, is_live_now):
+    room_id = st.session_state.room_id
+    if collect_here:
+        ingest_live_events(is_live_now)
+        # 配信の開始・終了はアプリ全体を再実行して、最終保存と自動更新の停止を行う
+        if is_live_now and not onlives_cache.is_live(room_id):
+            st.rerun()
+    elif viewer_snapshot_changed(room_id):
+        was_live = st.session_state.get("viewer_is_live")
+        load_viewer_snapshot(room_id)
+        if st.session_state.viewer_is_live != was_live:
+            st.rerun()
+    else:
+        load_viewer_rows()
+
+    st.markdown(f"**最終更新日時 (日本時間): {datetime.datetime.now(JST).strftime('%Y-%m-%d %H:%M:%S')}**")
+    st.markdown(f"<p style='font-size:12px; color:#a1a1a1;'>※配信中は約{DASHBOARD_TICK_SEC}秒ごとに更新されます（コメント・スペシャルギフトは約{POLL_INTERVAL}秒ごと）。</p>", unsafe_allow_html=True)
+
+    # 受信キューが溢れて捨てたフレームがあれば知らせる（FrameQueue の上限と方針は free_gift_handler.py）
+    receiver = st.session_state.get("ws_receiver")
+    dropped = getattr(getattr(receiver, "my_queue", None), "dropped", 0)
+    if collect_here and dropped:
+        st.warning(f"⚠️ 受信が追いつかず、無償ギフト・システムMSGのフレームを {dropped} 件破棄しました。")
+
+    # FTP保存は受け付けた後にバックグラウンドで行うので、最終的に失敗したファイルはここで知らせる
+    ftp_failures = ftp_uploader.failures_for(room_id) if collect_here else []
+    if ftp_failures:
+        name, error = ftp_failures[-1]
+        st.error(f"FTP保存に失敗したファイルが {len(ftp_failures)} 件あります（最新: {name}: {error}）")
+
+    # カラムを4つに分割
+    col_comment, col_gift, col_free_gift, col_fan = st.columns(4)
+    version = dashboard_version()
+
+    with col_comment:
+        st.markdown("###### 📝 コメント")
+        with st.container(border=True, height=500):
+            # システムコメントは取り込み時に振り分け済み
+            filtered_comments = st.session_state.comment_log
+            if filtered_comments:
+                # 💡 表示制限コントロール：新しい順に表示中のページ分だけ組み立て、1回の st.markdown で送る
+                html = dashboard_html("comment", version)
+                if html is None:
+                    display_comments = visible_rows(filtered_comments, "comment")
+                    html_parts = []
+                    for event_id, log in display_comments:
+                        html = st.session_state.row_html_cache.get(event_id)
+                        if html is not None:
+                            html_parts.append(html)
+                            continue
                         user_name = log.get('name', '匿名ユーザー')
                         comment_text = log.get('comment', '')
-                        created_at = datetime.datetime.fromtimestamp(log.get('created_at', 0), JST).strftime("%H:%M:%S")
+                        created_at = row_time(log)[-8:]  # "%H:%M:%S" の部分
                         avatar_url = log.get('avatar_url', '')
                         html = f"""
                         <div class="comment-item">
@@ -911,40 +786,49 @@ if st.session_state.is_tracking or st.session_state.get("room_id"):
                         </div>
                         <hr style="border: none; border-top: 1px solid #eee; margin: 8px 0;">
                         """
-                        st.markdown(html, unsafe_allow_html=True)
-                else:
-                    st.info("コメントはまだありません。")
-
-        with col_gift:
-            st.markdown("###### 🎁 スペシャルギフト")
-            with st.container(border=True, height=500):
-                if st.session_state.gift_log:
-                    # 最新のキャッシュを取得
+                        st.session_state.row_html_cache.put(event_id, html)
+                        html_parts.append(html)
+                    html = "".join(html_parts)
+                    st.session_state.dashboard_html["comment"] = (version, html)
+                st.markdown(html, unsafe_allow_html=True)
+                more_rows_button(filtered_comments, "comment")
+            else:
+                st.info("コメントはまだありません。")
+
+    with col_gift:
+        st.markdown("###### 🎁 スペシャルギフト")
+        with st.container(border=True, height=500):
+            if st.session_state.gift_log:
+                # 最新のキャッシュを取得
+                html = dashboard_html("gift", version)
+                if html is None:
                     current_map = st.session_state.gift_list_map
-                    display_gifts = st.session_state.gift_log
+                    display_gifts = visible_rows(st.session_state.gift_log, "gift")
+                    html_parts = []
+                    unknown_gift_ids = set()
                     
-                    for log in display_gifts:
-                        gid = str(log.get('gift_id'))
-                        
-                        # --- 💡 未知のギフトID対策ロジック ---
-                        if gid not in current_map:
-                            # リストにないIDが来たら、その場でAPIを叩き直す
-                            current_map = get_gift_list(st.session_state.room_id, force_update=True)
-                        # ----------------------------------
+                    for event_id, log in display_gifts:
+                        # ギフト名・ポイント・画像は取り込み時に付与済み（付いていない行だけギフトリストから引く）
+                        gift_name, gift_point, gift_image_url = gift_fields(log, current_map)
 
-                        gift_info = current_map.get(gid, {})
-                        if not gift_info:
+                        # --- 💡 未知のギフトID対策ロジック ---
+                        if gift_name is None:
+                            # 描画中はAPIを叩かず、ループ後にまとめて再取得を依頼する
+                            unknown_gift_ids.add(str(log.get('gift_id')))
                             # それでも取得できない場合のフォールバック
                             gift_name = "未知のギフト"
                             gift_point = 0
-                            gift_image_url = log.get('image', '')
-                        else:
-                            gift_name = gift_info.get('name', 'N/A')
-                            gift_point = gift_info.get('point', 0)
-                            gift_image_url = log.get('image', gift_info.get('image', ''))
+                        # ----------------------------------
+
+                        # ギフト情報が後から取得できた場合は組み立て直すよう、キーに含める
+                        cache_key = (event_id, gift_name, gift_point, gift_image_url) if event_id else None
+                        html = st.session_state.row_html_cache.get(cache_key)
+                        if html is not None:
+                            html_parts.append(html)
+                            continue
 
                         user_name = log.get('name', '匿名ユーザー')
-                        created_at = datetime.datetime.fromtimestamp(log.get('created_at', 0), JST).strftime("%H:%M:%S")
+                        created_at = row_time(log)[-8:]  # "%H:%M:%S" の部分
                         gift_count = log.get('num', 0)
                         total_point = gift_point * gift_count
                         
@@ -976,19 +860,35 @@ if st.session_state.is_tracking or st.session_state.get("room_id"):
                         </div>
                         <hr style="border: none; border-top: 1px solid #eee; margin: 8px 0;">
                         """
-                        st.markdown(html, unsafe_allow_html=True)
-                else:
-                    st.info("スペシャルギフトはまだありません。")
-
-        with col_free_gift:
-            st.markdown("###### 🎈 無償ギフト")
-            with st.container(border=True, height=500):
-                if st.session_state.free_gift_log:
-                    # 💡 表示制限コントロール
-                    display_free_gifts = st.session_state.free_gift_log # [:100]
-                    for log in display_free_gifts:
+                        st.session_state.row_html_cache.put(cache_key, html)
+                        html_parts.append(html)
+                    html = "".join(html_parts)
+                    st.session_state.dashboard_html["gift"] = (version, html)
+
+                    # 未知のギフトIDはバックグラウンドで1回だけカタログを取り直す（次回の更新で反映）
+                    if unknown_gift_ids and collect_here:
+                        gift_catalog_cache.request_unknown(st.session_state.room_id, unknown_gift_ids)
+                st.markdown(html, unsafe_allow_html=True)
+                more_rows_button(st.session_state.gift_log, "gift")
+            else:
+                st.info("スペシャルギフトはまだありません。")
+
+    with col_free_gift:
+        st.markdown("###### 🎈 無償ギフト")
+        with st.container(border=True, height=500):
+            if st.session_state.free_gift_log:
+                # 💡 表示制限コントロール
+                html = dashboard_html("free_gift", version)
+                if html is None:
+                    display_free_gifts = visible_rows(st.session_state.free_gift_log, "free_gift")
+                    html_parts = []
+                    for event_id, log in display_free_gifts:
+                        html = st.session_state.row_html_cache.get(event_id)
+                        if html is not None:
+                            html_parts.append(html)
+                            continue
                         user_name = log.get('name', '匿名ユーザー')
-                        created_at = datetime.datetime.fromtimestamp(log.get('created_at', 0), JST).strftime("%H:%M:%S")
+                        created_at = row_time(log)[-8:]  # "%H:%M:%S" の部分
                         gift_count = log.get('num', 0)
                         gift_point = log.get('point', 1) # 1pt
                         gift_image_url = log.get('image', '')
@@ -1013,16 +913,28 @@ if st.session_state.is_tracking or st.session_state.get("room_id"):
                         </div>
                         <hr style="border: none; border-top: 1px solid #eee; margin: 8px 0;">
                         """
-                        st.markdown(html, unsafe_allow_html=True)
-                else:
-                    st.info("無償ギフトはまだありません。")
-
-        with col_fan:
-            st.markdown("###### 🧡 システムMSG") 
-            with st.container(border=True, height=500):
-                if st.session_state.get("system_msg_log"):
-                    for log in st.session_state.system_msg_log:
-                        created_at = datetime.datetime.fromtimestamp(log.get('created_at', 0), JST).strftime("%H:%M:%S")
+                        st.session_state.row_html_cache.put(event_id, html)
+                        html_parts.append(html)
+                    html = "".join(html_parts)
+                    st.session_state.dashboard_html["free_gift"] = (version, html)
+                st.markdown(html, unsafe_allow_html=True)
+                more_rows_button(st.session_state.free_gift_log, "free_gift")
+            else:
+                st.info("無償ギフトはまだありません。")
+
+    with col_fan:
+        st.markdown("###### 🧡 システムMSG") 
+        with st.container(border=True, height=500):
+            if st.session_state.get("system_msg_log"):
+                html = dashboard_html("system_msg", version)
+                if html is None:
+                    html_parts = []
+                    for event_id, log in visible_rows(st.session_state.system_msg_log, "system_msg"):
+                        html = st.session_state.row_html_cache.get(event_id)
+                        if html is not None:
+                            html_parts.append(html)
+                            continue
+                        created_at = row_time(log)[-8:]  # "%H:%M:%S" の部分
                         msg_text = log.get('message', '')
                         
                         # --- 💡 ハイライト判定ロジック（優先順位順） ---
@@ -1073,16 +985,87 @@ if st.session_state.is_tracking or st.session_state.get("room_id"):
                         </div>
                         <hr style="border: none; border-top: 1px solid #eee; margin: 8px 0;">
                         """
-                        st.markdown(html, unsafe_allow_html=True)
-                else:
-                    st.info("システムメッセージはありません。")
+                        st.session_state.row_html_cache.put(event_id, html)
+                        html_parts.append(html)
+                    html = "".join(html_parts)
+                    st.session_state.dashboard_html["system_msg"] = (version, html)
+                st.markdown(html, unsafe_allow_html=True)
+                more_rows_button(st.session_state.system_msg_log, "system_msg")
+            else:
+                st.info("システムメッセージはありません。")
+
+
+if st.session_state.is_tracking or st.session_state.get("room_id"):
+    # 閲覧専用モード：collector.py の出力をセッション状態に読み込み、ここでは収集・保存を行わない
+    viewer_snapshot = load_viewer_snapshot(st.session_state.room_id) if st.session_state.get("viewer_mode") else None
+    collect_here = not st.session_state.get("viewer_mode")
+    if viewer_snapshot is not None:
+        onlives_data = {int(st.session_state.room_id): {}} if viewer_snapshot["is_live"] else {}
+    else:
+        if not collect_here:
+            st.warning("コレクターの出力が更新されていません。collector.py が動作しているか確認してください。")
+        onlives_data = onlives_cache.get()
+    target_room_info = onlives_data.get(int(st.session_state.room_id)) if st.session_state.room_id.isdigit() else None
+
+    # --- 配信終了検知と自動保存処理 ---
+    # インデントを一段（半角スペース4つ）に統一しています
+    is_live_now = int(st.session_state.room_id) in onlives_data
+
+    if not is_live_now and collect_here:
+        # st.warning("📡 配信が終了しました。全ログを最終保存します。")
+        st.info("📡 配信の終了を確認しました。未保存のログを含め、最終データを保存します。")
+
+        # コメント・ギフト・無償ギフト・システムMSGの未保存分を最後のセグメントとして保存し、
+        # セグメントをつなげた全件ファイルも1つ保存する
+        if st.session_state.get("exports"):
+            for log_type, exporter in st.session_state.exports.items():
+                exporter.finish(st.session_state[f"{log_type}_log"])
+
+        # 配信が終了しても、表示用のフラグを「停止」にせず、警告を出すだけにする
+        # st.session_state.is_tracking = False  # 消去またはコメントアウト
+        # st.warning("📡 配信が終了しました。ログを最終保存しました。このまま振り返りが可能です。")
+        # st.success("✅ 最終保存が完了しました。このままデータの確認や手動ダウンロードが可能です。")
+        st.success("✅ 最終保存が完了しました。自動更新を停止し、現在のログを保持しています。このままデータの確認やダウンロードが可能です。")
+        # st.rerun()  # 消去またはコメントアウト
+
+
+    if target_room_info or st.session_state.get("room_id"):
+        room_id = st.session_state.room_id
+
+        # ルーム名取得
+        try:
+            prof = api_get(f"https://www.showroom-live.com/api/room/profile?room_id={room_id}").json()
+            room_name = prof.get("room_name", f"ルームID {room_id}")
+        except Exception:
+            room_name = f"ルームID {room_id}"
+        # URLキー取得
+        room_url_key = prof.get("room_url_key", "")
+        room_url = f"https://www.showroom-live.com/r/{room_url_key}" if room_url_key else f"https://www.showroom-live.com/room/profile?room_id={room_id}"
+        link_html = f'<a href="{room_url}" target="_blank" style="font-weight:bold; text-decoration:underline; color:inherit;">{room_name}</a>'        
+        # 配信状態によってメッセージを切り替える
+        if is_live_now:
+            # 配信中（緑色）
+            st.markdown(f'<div class="tracking-success">📡 {link_html} の配信をトラッキング中です。</div>', unsafe_allow_html=True)
+        else:
+            # 💡 ここを直接書き込みから「クラス指定」に変更します
+            st.markdown(f'<div class="tracking-info">🏁 {link_html} の配信は終了しました。</div>', unsafe_allow_html=True)
+
+        st.markdown("---")
+        st.markdown("<h2 style='font-size:2em;'>📊 リアルタイムダッシュボード</h2>", unsafe_allow_html=True)
+        # 配信中の時だけ定期的に再実行し、新しいログを取得しにいく
+        st.fragment(live_dashboard, run_every=DASHBOARD_TICK_SEC if is_live_now else None)(collect_here, is_live_now)
     else:
         st.warning("指定されたルームIDが見つからないか、認証されていないルームIDか、現在配信中ではありません。")
         st.session_state.is_tracking = False
 
 
-# if st.session_state.is_tracking and st.session_state.room_id:
-if st.session_state.get("room_id"):
+# --- ログ詳細 ---
+# 集計表やデータフレームは組み立てが重いので、ダッシュボードとは別のフラグメントにして
+# 配信中は LOG_DETAILS_REFRESH_SEC ごとにだけ再実行する
+LOG_DETAILS_REFRESH_SEC = POLL_INTERVAL
+
+
+def log_details():
 
     st.markdown("---")
     st.markdown("<h2 style='font-size:2em;'>📝 ログ詳細</h2>", unsafe_allow_html=True)
@@ -1096,8 +1079,8 @@ if st.session_state.get("room_id"):
         f"{len(st.session_state.free_gift_log)} 件の無償ギフト、"
         f"{sys_msg_count} 件のシステムMSG、" # 追加
         f"および {st.session_state.total_fan_count} 名のファンのデータが蓄積されています。<br />"
-        f"※誤ってリロード（再読み込み）してしまった、閉じてしまった等でダウンロードせずに消失してしまった場合、"
-        f"運営にご相談いただければ、ログ取得できる可能性があります。<br />"
+        f"※誤ってリロード（再読み込み）してしまった、閉じてしまった等の場合も、配信中に同じルームIDで再度トラッキングを開始すれば、"
+        f"それまでに取得したログが復元されます。<br />"
         f"※各タブを選択し、必要に応じて「＞」で詳細を展開してください。</p>", 
         unsafe_allow_html=True
     )
@@ -1113,20 +1096,20 @@ if st.session_state.get("room_id"):
     with tab_com:
         # --- 1. コメントログ部分 ---
         with st.expander("📝 コメントログ一覧", expanded=True):
-            filtered_comments = [
-                log for log in st.session_state.comment_log 
-                if not any(keyword in log.get('name', '') or keyword in log.get('comment', '') for keyword in SYSTEM_COMMENT_KEYWORDS)
-            ]
-            if filtered_comments:
-                c_df = pd.DataFrame(filtered_comments)
-                c_df['コメント時間'] = pd.to_datetime(c_df['created_at'], unit='s').dt.tz_localize('UTC').dt.tz_convert(JST).dt.strftime("%Y-%m-%d %H:%M:%S")
-                c_df = c_df.rename(columns={'name': 'ユーザー名', 'comment': 'コメント内容', 'user_id': 'ユーザーID'})
-                
-                st.dataframe(c_df[['コメント時間', 'ユーザー名', 'コメント内容']], use_container_width=True, hide_index=True)
-                
-                buf_com = io.BytesIO()
-                c_df[['コメント時間', 'ユーザー名', 'ユーザーID', 'コメント内容']].to_csv(buf_com, index=False, encoding='utf-8-sig')
-                st.download_button("コメントログをダウンロード", buf_com.getvalue(), f"comment_log_{st.session_state.room_id}.csv", "text/csv", key="dl_c")
+            if st.session_state.comment_log:
+                def build_comment_tables():
+                    filtered_comments = list(st.session_state.comment_log)
+                    c_df = pd.DataFrame(filtered_comments)
+                    c_df['コメント時間'] = [row_time(log) for log in filtered_comments]
+                    c_df = c_df.rename(columns={'name': 'ユーザー名', 'comment': 'コメント内容', 'user_id': 'ユーザーID'})
+                    out_df = c_df[['コメント時間', 'ユーザー名', 'ユーザーID', 'コメント内容']]
+                    return c_df[['コメント時間', 'ユーザー名', 'コメント内容']], out_df, csv_bytes(out_df)
+
+                version = data_version(st.session_state.comment_log)
+                c_view, c_out, c_csv = cached_tables("comment", version, build_comment_tables)
+                st.dataframe(c_view, use_container_width=True, hide_index=True)
+                st.download_button("コメントログをダウンロード", c_csv, f"comment_log_{st.session_state.room_id}.csv", "text/csv", key="dl_c")
+                parquet_download_button("コメントログをダウンロード (Parquet)", c_out, f"comment_log_{st.session_state.room_id}.parquet", key="dl_c_pq", version=version)
             else:
                 st.info("コメントデータがありません。")
 
@@ -1134,14 +1117,16 @@ if st.session_state.get("room_id"):
         with st.expander("🧡 システムMSGログ一覧", expanded=True):
             system_msgs = st.session_state.get("system_msg_log", [])
             if system_msgs:
-                s_msg_df = pd.DataFrame(system_msgs)
-                # 表示時間の変換
-                s_msg_df['表示時間'] = pd.to_datetime(s_msg_df['created_at'], unit='s').dt.tz_localize('UTC').dt.tz_convert(JST).dt.strftime("%Y-%m-%d %H:%M:%S")
-                # カラム名の整理
-                s_msg_df = s_msg_df.rename(columns={'message': '表示内容'})
-                
+                def build_system_msg_table():
+                    s_msg_df = pd.DataFrame(system_msgs)
+                    # 表示時間の変換
+                    s_msg_df['表示時間'] = [row_time(log) for log in system_msgs]
+                    # カラム名の整理
+                    s_msg_df = s_msg_df.rename(columns={'message': '表示内容'})
+                    return s_msg_df[['表示時間', '表示内容']]
+
                 # 表示用データフレーム（CSVダウンロード不要とのことなので表示のみ）
-                st.dataframe(s_msg_df[['表示時間', '表示内容']], use_container_width=True, hide_index=True)
+                st.dataframe(cached_tables("system_msg", data_version(system_msgs), build_system_msg_table), use_container_width=True, hide_index=True)
             else:
                 st.info("システムメッセージデータがありません。")
 
@@ -1150,52 +1135,36 @@ if st.session_state.get("room_id"):
     # ==========================================
     with tab_sp:
         if st.session_state.gift_log:
-            s_raw = pd.DataFrame(st.session_state.gift_log)
-            if st.session_state.gift_list_map:
-                g_info = pd.DataFrame.from_dict(st.session_state.gift_list_map, orient='index')
-                g_info.index = g_info.index.astype(str)
-                s_raw['gift_id'] = s_raw['gift_id'].astype(str)
-                s_raw = s_raw.set_index('gift_id').join(g_info, on='gift_id', lsuffix='_u', rsuffix='_g').reset_index()
+            def build_special_gift_tables():
+                # ギフト名・ポイントは取り込み時に付与済みなので、ギフトリストとの結合はしない
+                s_raw = pd.DataFrame(special_gift_rows(st.session_state.gift_log))
+                s_disp = s_raw.copy()
+                s_disp['ギフト時間'] = s_disp['time']
+                s_disp['合計Pt（※単純合計値）'] = (pd.to_numeric(s_disp['num']) * pd.to_numeric(s_disp['point'])).astype(int)
+                s_disp = s_disp.rename(columns={'name': 'ユーザー名', 'gift_name': 'ギフト名', 'num': '個数', 'point': 'ポイント', 'user_id': 'ユーザーID'})
+                out_df = s_disp[['ギフト時間', 'ユーザー名', 'ユーザーID', 'ギフト名', '個数', 'ポイント', '合計Pt（※単純合計値）']]
+                s_groups = tally_groups([(gift_tally(st.session_state.gift_log), resolve_special_gift)])
+                return (
+                    s_disp[['ギフト時間', 'ユーザー名', 'ギフト名', '個数', 'ポイント', '合計Pt（※単純合計値）']], out_df, csv_bytes(out_df),
+                    gift_sum_df(s_groups), user_ranking_df(s_groups),
+                )
+
+            version = data_version(st.session_state.gift_log, st.session_state.gift_list_map)
+            s_view, s_out, s_csv, s_sum, s_ranking = cached_tables("gift", version, build_special_gift_tables)
 
             # 1. 全量一覧
             with st.expander("📜 スペシャルギフトログ一覧表 (全量)", expanded=True):
-                s_disp = s_raw.copy()
-                s_disp['ギフト時間'] = pd.to_datetime(s_disp['created_at'], unit='s').dt.tz_localize('UTC').dt.tz_convert(JST).dt.strftime("%Y-%m-%d %H:%M:%S")
-                s_disp['合計Pt（※単純合計値）'] = (pd.to_numeric(s_disp['num']) * pd.to_numeric(s_disp['point'])).astype(int)
-                s_disp = s_disp.rename(columns={'name_u': 'ユーザー名', 'name_g': 'ギフト名', 'num': '個数', 'point': 'ポイント', 'user_id': 'ユーザーID'})
-                st.dataframe(s_disp[['ギフト時間', 'ユーザー名', 'ギフト名', '個数', 'ポイント', '合計Pt（※単純合計値）']], use_container_width=True, hide_index=True)
-                
-                buf_s1 = io.BytesIO()
-                s_disp[['ギフト時間', 'ユーザー名', 'ユーザーID', 'ギフト名', '個数', 'ポイント', '合計Pt（※単純合計値）']].to_csv(buf_s1, index=False, encoding='utf-8-sig')
-                st.download_button("スペシャルギフトログをダウンロード", buf_s1.getvalue(), "sp_gift_all.csv", "text/csv", key="dl_s1")
+                st.dataframe(s_view, use_container_width=True, hide_index=True)
+                st.download_button("スペシャルギフトログをダウンロード", s_csv, "sp_gift_all.csv", "text/csv", key="dl_s1")
+                parquet_download_button("スペシャルギフトログをダウンロード (Parquet)", s_out, "sp_gift_all.parquet", key="dl_s1_pq", version=version)
 
             # 2. ギフト単位合算
             with st.expander("🎁 ユーザー単位でギフト合算集計", expanded=False):
-                s_sum = s_raw.groupby(['user_id', 'name_g', 'point'], as_index=False).agg({'num': 'sum', 'created_at': 'max', 'name_u': 'last'})
-                s_sum['合計Pt（※単純合計値）'] = (s_sum['num'] * pd.to_numeric(s_sum['point'])).astype(int)
-                s_sum['最新ギフト時間'] = pd.to_datetime(s_sum['created_at'], unit='s').dt.tz_localize('UTC').dt.tz_convert(JST).dt.strftime("%Y-%m-%d %H:%M:%S")
-                s_sum = s_sum.rename(columns={'name_u': 'ユーザー名', 'name_g': 'ギフト名', 'num': '合計個数', 'point': 'ポイント', 'user_id': 'ユーザーID'}).sort_values('最新ギフト時間', ascending=False)
-                st.dataframe(s_sum[['最新ギフト時間', 'ユーザー名', 'ギフト名', '合計個数', 'ポイント', '合計Pt（※単純合計値）']], use_container_width=True, hide_index=True)
+                st.dataframe(s_sum, use_container_width=True, hide_index=True)
 
             # 3. ユーザー単位集計 (貢献順)
             with st.expander("👤 ユーザー単位で集計 (総貢献Pt順)", expanded=False):
-                s_user = s_raw.copy()
-                s_user['line_pt'] = pd.to_numeric(s_user['num']) * pd.to_numeric(s_user['point'])
-                latest_names = s_user.sort_values('created_at').groupby('user_id')['name_u'].last()
-                u_agg = s_user.groupby(['user_id', 'name_g', 'point'], as_index=False).agg({'num': 'sum', 'line_pt': 'sum'})
-                u_total = u_agg.groupby('user_id')['line_pt'].sum().rename('総Pt')
-                u_merged = u_agg.merge(u_total, on='user_id').sort_values(['総Pt', 'user_id', 'line_pt'], ascending=[False, True, False])
-                
-                u_rows = []
-                prev_id = None
-                for _, r in u_merged.iterrows():
-                    u_rows.append({
-                        'ユーザー名': latest_names[r['user_id']] if r['user_id'] != prev_id else '',
-                        'ギフト名': r['name_g'], '合計個数': r['num'], 'ポイント': r['point'],
-                        'ギフト単位Pt': int(r['line_pt']), '総貢献Pt（※単純合計値）': int(r['総Pt']) if r['user_id'] != prev_id else ''
-                    })
-                    prev_id = r['user_id']
-                st.dataframe(pd.DataFrame(u_rows), use_container_width=True, hide_index=True)
+                st.dataframe(s_ranking, use_container_width=True, hide_index=True)
         else:
             st.info("スペシャルギフトデータがありません。")
 
@@ -1204,44 +1173,32 @@ if st.session_state.get("room_id"):
     # ==========================================
     with tab_free:
         if st.session_state.free_gift_log:
-            f_raw = pd.DataFrame(st.session_state.free_gift_log)
-            
-            with st.expander("📜 無償ギフトログ一覧表 (全量)", expanded=True):
+            def build_free_gift_tables():
+                f_raw = pd.DataFrame(st.session_state.free_gift_log)
                 f_disp = f_raw.copy()
-                f_disp['ギフト時間'] = pd.to_datetime(f_disp['created_at'], unit='s').dt.tz_localize('UTC').dt.tz_convert(JST).dt.strftime("%Y-%m-%d %H:%M:%S")
+                f_disp['ギフト時間'] = f_disp['time']
                 f_disp['合計Pt（※単純合計値）'] = (pd.to_numeric(f_disp['num']) * pd.to_numeric(f_disp['point'])).astype(int)
                 f_disp = f_disp.rename(columns={'name': 'ユーザー名', 'gift_name': 'ギフト名', 'num': '個数', 'point': 'ポイント', 'user_id': 'ユーザーID'})
-                st.dataframe(f_disp[['ギフト時間', 'ユーザー名', 'ギフト名', '個数', 'ポイント', '合計Pt（※単純合計値）']], use_container_width=True, hide_index=True)
-                
-                buf_f1 = io.BytesIO()
-                f_disp[['ギフト時間', 'ユーザー名', 'ユーザーID', 'ギフト名', '個数', 'ポイント', '合計Pt（※単純合計値）']].to_csv(buf_f1, index=False, encoding='utf-8-sig')
-                st.download_button("無償ギフトログをダウンロード", buf_f1.getvalue(), "free_gift_all.csv", "text/csv", key="dl_f1")
+                out_df = f_disp[['ギフト時間', 'ユーザー名', 'ユーザーID', 'ギフト名', '個数', 'ポイント', '合計Pt（※単純合計値）']]
+                f_groups = tally_groups([(gift_tally(st.session_state.free_gift_log), resolve_free_gift)])
+                return (
+                    f_disp[['ギフト時間', 'ユーザー名', 'ギフト名', '個数', 'ポイント', '合計Pt（※単純合計値）']], out_df, csv_bytes(out_df),
+                    gift_sum_df(f_groups), user_ranking_df(f_groups),
+                )
+
+            version = data_version(st.session_state.free_gift_log)
+            f_view, f_out, f_csv, f_sum, f_ranking = cached_tables("free_gift", version, build_free_gift_tables)
+
+            with st.expander("📜 無償ギフトログ一覧表 (全量)", expanded=True):
+                st.dataframe(f_view, use_container_width=True, hide_index=True)
+                st.download_button("無償ギフトログをダウンロード", f_csv, "free_gift_all.csv", "text/csv", key="dl_f1")
+                parquet_download_button("無償ギフトログをダウンロード (Parquet)", f_out, "free_gift_all.parquet", key="dl_f1_pq", version=version)
 
             with st.expander("🎈 ユーザー単位でギフト合算集計", expanded=False):
-                f_sum = f_raw.groupby(['user_id', 'gift_name', 'point'], as_index=False).agg({'num': 'sum', 'created_at': 'max', 'name': 'last'})
-                f_sum['合計Pt（※単純合計値）'] = (f_sum['num'] * pd.to_numeric(f_sum['point'])).astype(int)
-                f_sum['最新ギフト時間'] = pd.to_datetime(f_sum['created_at'], unit='s').dt.tz_localize('UTC').dt.tz_convert(JST).dt.strftime("%Y-%m-%d %H:%M:%S")
-                f_sum = f_sum.rename(columns={'name': 'ユーザー名', 'gift_name': 'ギフト名', 'num': '合計個数', 'point': 'ポイント'}).sort_values('最新ギフト時間', ascending=False)
-                st.dataframe(f_sum[['最新ギフト時間', 'ユーザー名', 'ギフト名', '合計個数', 'ポイント', '合計Pt（※単純合計値）']], use_container_width=True, hide_index=True)
+                st.dataframe(f_sum, use_container_width=True, hide_index=True)
 
             with st.expander("👤 ユーザー単位で集計 (総貢献Pt順)", expanded=False):
-                f_u_df = f_raw.copy()
-                f_u_df['line_pt'] = pd.to_numeric(f_u_df['num']) * pd.to_numeric(f_u_df['point'])
-                latest_f_names = f_u_df.sort_values('created_at').groupby('user_id')['name'].last()
-                f_u_agg = f_u_df.groupby(['user_id', 'gift_name', 'point'], as_index=False).agg({'num': 'sum', 'line_pt': 'sum'})
-                f_u_total = f_u_agg.groupby('user_id')['line_pt'].sum().rename('総Pt')
-                f_u_merged = f_u_agg.merge(f_u_total, on='user_id').sort_values(['総Pt', 'user_id', 'line_pt'], ascending=[False, True, False])
-                
-                f_u_rows = []
-                prev_f_id = None
-                for _, r in f_u_merged.iterrows():
-                    f_u_rows.append({
-                        'ユーザー名': latest_f_names[r['user_id']] if r['user_id'] != prev_f_id else '',
-                        'ギフト名': r['gift_name'], '合計個数': r['num'], 'ポイント': r['point'],
-                        'ギフト単位Pt': int(r['line_pt']), '総貢献Pt（※単純合計値）': int(r['総Pt']) if r['user_id'] != prev_f_id else ''
-                    })
-                    prev_f_id = r['user_id']
-                st.dataframe(pd.DataFrame(f_u_rows), use_container_width=True, hide_index=True)
+                st.dataframe(f_ranking, use_container_width=True, hide_index=True)
         else:
             st.info("無償ギフトデータがありません。")
 
@@ -1250,60 +1207,45 @@ if st.session_state.get("room_id"):
     # ==========================================
    
     with tab_all:
-        combined_data = []
-        if st.session_state.gift_log:
-            s_part = pd.DataFrame(st.session_state.gift_log)
-            if st.session_state.gift_list_map:
-                g_map = pd.DataFrame.from_dict(st.session_state.gift_list_map, orient='index')
-                s_part['gift_id'] = s_part['gift_id'].astype(str)
-                s_part = s_part.set_index('gift_id').join(g_map, on='gift_id', lsuffix='_u', rsuffix='_g').reset_index()
-                s_part = s_part.rename(columns={'name_u': 'name', 'name_g': 'gift_name'})
-            combined_data.append(s_part[['created_at', 'name', 'user_id', 'gift_name', 'num', 'point']])
-        
-        if st.session_state.free_gift_log:
-            f_part = pd.DataFrame(st.session_state.free_gift_log)
-            combined_data.append(f_part[['created_at', 'name', 'user_id', 'gift_name', 'num', 'point']])
+        if st.session_state.gift_log or st.session_state.free_gift_log:
+            def build_combined_tables():
+                combined_data = []
+                if st.session_state.gift_log:
+                    s_part = pd.DataFrame(special_gift_rows(st.session_state.gift_log))
+                    combined_data.append(s_part[['created_at', 'time', 'name', 'user_id', 'gift_name', 'num', 'point']])
 
-        if combined_data:
-            all_df = pd.concat(combined_data, ignore_index=True)
-            all_df['created_at_dt'] = pd.to_datetime(all_df['created_at'], unit='s')
+                if st.session_state.free_gift_log:
+                    f_part = pd.DataFrame(st.session_state.free_gift_log)
+                    combined_data.append(f_part[['created_at', 'time', 'name', 'user_id', 'gift_name', 'num', 'point']])
 
-            with st.expander("📜 SP&無償ギフトログ一覧表 (全量)", expanded=True):
+                all_df = pd.concat(combined_data, ignore_index=True)
                 all_disp = all_df.sort_values('created_at', ascending=False).copy()
-                all_disp['ギフト時間'] = all_disp['created_at_dt'].dt.tz_localize('UTC').dt.tz_convert(JST).dt.strftime("%Y-%m-%d %H:%M:%S")
+                all_disp['ギフト時間'] = all_disp['time']
                 all_disp['合計Pt（※単純合計値）'] = (pd.to_numeric(all_disp['num']) * pd.to_numeric(all_disp['point'])).astype(int)
                 all_disp = all_disp.rename(columns={'name': 'ユーザー名', 'gift_name': 'ギフト名', 'num': '個数', 'point': 'ポイント', 'user_id': 'ユーザーID'})
-                st.dataframe(all_disp[['ギフト時間', 'ユーザー名', 'ギフト名', '個数', 'ポイント', '合計Pt（※単純合計値）']], use_container_width=True, hide_index=True)
-                
-                buf_all1 = io.BytesIO()
-                all_disp[['ギフト時間', 'ユーザー名', 'ユーザーID', 'ギフト名', '個数', 'ポイント', '合計Pt（※単純合計値）']].to_csv(buf_all1, index=False, encoding='utf-8-sig')
-                st.download_button("SP&無償ギフトログをダウンロード", buf_all1.getvalue(), "combined_gift_all.csv", "text/csv", key="dl_all1")
+                out_df = all_disp[['ギフト時間', 'ユーザー名', 'ユーザーID', 'ギフト名', '個数', 'ポイント', '合計Pt（※単純合計値）']]
+                all_groups = tally_groups([
+                    (gift_tally(st.session_state.gift_log), resolve_special_gift),
+                    (gift_tally(st.session_state.free_gift_log), resolve_free_gift),
+                ])
+                return (
+                    all_disp[['ギフト時間', 'ユーザー名', 'ギフト名', '個数', 'ポイント', '合計Pt（※単純合計値）']], out_df, csv_bytes(out_df),
+                    gift_sum_df(all_groups), user_ranking_df(all_groups),
+                )
+
+            version = data_version(st.session_state.gift_log, st.session_state.free_gift_log, st.session_state.gift_list_map)
+            all_view, all_out, all_csv, all_sum, all_ranking = cached_tables("combined", version, build_combined_tables)
+
+            with st.expander("📜 SP&無償ギフトログ一覧表 (全量)", expanded=True):
+                st.dataframe(all_view, use_container_width=True, hide_index=True)
+                st.download_button("SP&無償ギフトログをダウンロード", all_csv, "combined_gift_all.csv", "text/csv", key="dl_all1")
+                parquet_download_button("SP&無償ギフトログをダウンロード (Parquet)", all_out, "combined_gift_all.parquet", key="dl_all1_pq", version=version)
 
             with st.expander("🎁🎈 ユーザー単位でギフト合算集計", expanded=False):
-                all_sum = all_df.groupby(['user_id', 'gift_name', 'point'], as_index=False).agg({'num': 'sum', 'created_at_dt': 'max', 'name': 'last'})
-                all_sum['合計Pt（※単純合計値）'] = (all_sum['num'] * pd.to_numeric(all_sum['point'])).astype(int)
-                all_sum['最新ギフト時間'] = all_sum['created_at_dt'].dt.tz_localize('UTC').dt.tz_convert(JST).dt.strftime("%Y-%m-%d %H:%M:%S")
-                all_sum = all_sum.rename(columns={'name': 'ユーザー名', 'gift_name': 'ギフト名', 'num': '合計個数', 'point': 'ポイント'}).sort_values('最新ギフト時間', ascending=False)
-                st.dataframe(all_sum[['最新ギフト時間', 'ユーザー名', 'ギフト名', '合計個数', 'ポイント', '合計Pt（※単純合計値）']], use_container_width=True, hide_index=True)
+                st.dataframe(all_sum, use_container_width=True, hide_index=True)
 
             with st.expander("👤 ユーザー単位で集計 (総貢献Pt順)", expanded=False):
-                all_u = all_df.copy()
-                all_u['line_pt'] = pd.to_numeric(all_u['num']) * pd.to_numeric(all_u['point'])
-                latest_all_names = all_u.sort_values('created_at').groupby('user_id')['name'].last()
-                all_u_agg = all_u.groupby(['user_id', 'gift_name', 'point'], as_index=False).agg({'num': 'sum', 'line_pt': 'sum'})
-                all_u_total = all_u_agg.groupby('user_id')['line_pt'].sum().rename('総Pt')
-                all_u_merged = all_u_agg.merge(all_u_total, on='user_id').sort_values(['総Pt', 'user_id', 'line_pt'], ascending=[False, True, False])
-                
-                all_u_rows = []
-                prev_all_id = None
-                for _, r in all_u_merged.iterrows():
-                    all_u_rows.append({
-                        'ユーザー名': latest_all_names[r['user_id']] if r['user_id'] != prev_all_id else '',
-                        'ギフト名': r['gift_name'], '合計個数': r['num'], 'ポイント': r['point'],
-                        'ギフト単位Pt': int(r['line_pt']), '総貢献Pt（※単純合計値）': int(r['総Pt']) if r['user_id'] != prev_all_id else ''
-                    })
-                    prev_all_id = r['user_id']
-                st.dataframe(pd.DataFrame(all_u_rows), use_container_width=True, hide_index=True)
+                st.dataframe(all_ranking, use_container_width=True, hide_index=True)
         else:
             st.info("SP&無償ギフトデータがありません。")
 
@@ -1312,18 +1254,25 @@ if st.session_state.get("room_id"):
     # ==========================================
     with tab_fan:
         if st.session_state.fan_list:
-            raw_fan_df = pd.DataFrame(st.session_state.fan_list)
-            rename_map = {'rank': '順位', 'level': 'レベル', 'user_name': 'ユーザー名', 'point': 'ポイント', 'user_id': 'ユーザーID'}
-            existing_rename_map = {k: v for k, v in rename_map.items() if k in raw_fan_df.columns}
-            fan_df = raw_fan_df.rename(columns=existing_rename_map)
-            desired_cols = ['順位', 'レベル', 'ユーザー名', 'ポイント', 'ユーザーID']
-            final_display_cols = [c for c in desired_cols if c in fan_df.columns]
-            
+            def build_fan_table():
+                raw_fan_df = pd.DataFrame(st.session_state.fan_list)
+                rename_map = {'rank': '順位', 'level': 'レベル', 'user_name': 'ユーザー名', 'point': 'ポイント', 'user_id': 'ユーザーID'}
+                existing_rename_map = {k: v for k, v in rename_map.items() if k in raw_fan_df.columns}
+                fan_df = raw_fan_df.rename(columns=existing_rename_map)
+                desired_cols = ['順位', 'レベル', 'ユーザー名', 'ポイント', 'ユーザーID']
+                final_display_cols = [c for c in desired_cols if c in fan_df.columns]
+                return fan_df[final_display_cols], csv_bytes(fan_df[final_display_cols])
+
+            version = data_version(st.session_state.fan_list)
+            fan_view, fan_csv = cached_tables("fan", version, build_fan_table)
+
             st.markdown("### 🏆 ファンリスト一覧")
-            st.dataframe(fan_df[final_display_cols], use_container_width=True, hide_index=True)
-            
-            buf_fan = io.BytesIO()
-            fan_df[final_display_cols].to_csv(buf_fan, index=False, encoding='utf-8-sig')
-            st.download_button(label="ファンリストをダウンロード", data=buf_fan.getvalue(), file_name=f"fan_list_{st.session_state.room_id}.csv", mime="text/csv", key="dl_f_final")
+            st.dataframe(fan_view, use_container_width=True, hide_index=True)
+            st.download_button(label="ファンリストをダウンロード", data=fan_csv, file_name=f"fan_list_{st.session_state.room_id}.csv", mime="text/csv", key="dl_f_final")
+            parquet_download_button("ファンリストをダウンロード (Parquet)", fan_view, f"fan_list_{st.session_state.room_id}.parquet", key="dl_f_final_pq", version=version)
         else:
-            st.info("ファンデータがありません。")
\ No newline at end of file
+            st.info("ファンデータがありません。")
+
+# if st.session_state.is_tracking and st.session_state.room_id:
+if st.session_state.get("room_id"):
+    st.fragment(log_details, run_every=LOG_DETAILS_REFRESH_SEC if is_live_now else None)()
\ No newline at end of file
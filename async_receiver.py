@@ -0,0 +1,175 @@
+import asyncio
+import random
+import threading
+
+import websockets
+
+from free_gift_handler import (
+    MAX_KEYS_PER_CONNECTION, FrameQueue, parse_frame, active_receivers, receivers_lock,
+    current_session_id, start_receiver_reaper,
+)
+
+# --- asyncio版の受信エンジン（FreeGiftReceiver の代替） ---
+# 1本のイベントループ上で全ホスト・全ルームの購読を扱い、スレッドは接続数に関係なく1本だけ。
+# 再接続は接続ごとに指数バックオフ＋ジッター（full jitter）で待つので、
+# 配信サーバー再起動時に全接続が同じタイミングで再接続する「一斉再接続」を避けられる。
+
+BACKOFF_BASE_SEC = 1.0
+BACKOFF_MAX_SEC = 60.0
+
+
+class AsyncBroadcastConnection:
+    """1本の WebSocket 接続。購読状態はイベントループのスレッドからのみ操作する"""
+
+    def __init__(self, loop, host):
+        self.loop = loop
+        self.host = host
+        self.ws = None
+        self.task = None
+        # key -> そのキーを購読しているキューのリスト
+        self.subscribers = {}
+
+    def subscribe(self, key, target_queue):
+        is_new_key = key not in self.subscribers
+        self.subscribers.setdefault(key, []).append(target_queue)
+        if is_new_key and self.ws is not None:
+            self.loop.create_task(self.send_sub(key))
+        if self.task is None:
+            self.task = self.loop.create_task(self.run())
+
+    def unsubscribe(self, key, target_queue):
+        """購読を外す。購読キーが無くなった場合は接続を閉じて True を返す"""
+        queues = self.subscribers.get(key, [])
+        if target_queue in queues:
+            queues.remove(target_queue)
+        if not queues:
+            self.subscribers.pop(key, None)
+        if not self.subscribers and self.task is not None:
+            self.task.cancel()
+            self.task = None
+            return True
+        return False
+
+    async def send_sub(self, key):
+        try:
+            await self.ws.send(f"SUB\t{key}")
+        except Exception as e:
+            # 送れなかった分は再接続時にまとめて SUB される
+            print(f"WebSocket SUB Error: {e}")
+
+    def on_message(self, message):
+        try:
+            if isinstance(message, bytes):
+                message = message.decode("utf-8")
+            parsed = parse_frame(message)
+            if parsed is None:
+                return
+            key, data = parsed
+            for target_queue in self.subscribers.get(key, []):
+                target_queue.put(data)
+        except Exception as e:
+            print(f"WebSocket Message Error: {e}")
+
+    async def run(self):
+        ws_url = f"wss://{self.host}:443/"
+        attempt = 0
+        while True:
+            try:
+                async with websockets.connect(ws_url, ping_interval=30, ping_timeout=10) as ws:
+                    self.ws = ws
+                    # 再接続時も含め、現在の購読キーをすべて SUB し直す
+                    for key in list(self.subscribers):
+                        await ws.send(f"SUB\t{key}")
+                    print(f"WebSocket Connected: {self.host} ({len(self.subscribers)} rooms)")
+                    attempt = 0
+                    async for message in ws:
+                        self.on_message(message)
+                print(f"WebSocket Closed: {self.host}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"WebSocket Run Error: {e}")
+            finally:
+                self.ws = None
+
+            # 指数バックオフ＋ジッター：0〜上限の範囲でランダムに待つ
+            attempt += 1
+            await asyncio.sleep(random.uniform(0, min(BACKOFF_MAX_SEC, BACKOFF_BASE_SEC * 2 ** attempt)))
+
+
+class AsyncBroadcastEngine:
+    """イベントループを専用スレッドで回し、ホストごとの接続を管理する"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        # host -> AsyncBroadcastConnection のリスト（ループのスレッドからのみ操作）
+        self.connections = {}
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def subscribe(self, host, key, target_queue):
+        self.loop.call_soon_threadsafe(self._subscribe, host, key, target_queue)
+
+    def unsubscribe(self, host, key, target_queue):
+        self.loop.call_soon_threadsafe(self._unsubscribe, host, key, target_queue)
+
+    def _subscribe(self, host, key, target_queue):
+        connections = self.connections.setdefault(host, [])
+        conn = next((c for c in connections if key in c.subscribers), None)
+        if conn is None:
+            conn = next((c for c in connections if len(c.subscribers) < MAX_KEYS_PER_CONNECTION), None)
+        if conn is None:
+            conn = AsyncBroadcastConnection(self.loop, host)
+            connections.append(conn)
+        conn.subscribe(key, target_queue)
+
+    def _unsubscribe(self, host, key, target_queue):
+        connections = self.connections.get(host, [])
+        for conn in connections:
+            if target_queue in conn.subscribers.get(key, []):
+                if conn.unsubscribe(key, target_queue):
+                    connections.remove(conn)
+                break
+        if not connections:
+            self.connections.pop(host, None)
+
+
+engine = None
+engine_lock = threading.Lock()
+
+
+def get_engine():
+    global engine
+    with engine_lock:
+        if engine is None:
+            engine = AsyncBroadcastEngine()
+        return engine
+
+
+class AsyncFreeGiftReceiver:
+    """FreeGiftReceiver と同じ start()/stop()/my_queue を持つ asyncio 版の受信機"""
+
+    def __init__(self, room_id, host, key):
+        self.room_id = room_id
+        self.host = host
+        self.key = key
+        self.is_running = False
+        # 取り出し側（Streamlitのスレッド等）からは通常のキューとして扱える
+        self.my_queue = FrameQueue()
+        # 起動したブラウザタブのセッション（タブを閉じたら reap_abandoned_receivers() が停止する）
+        self.session_id = current_session_id()
+
+    def start(self):
+        if not self.is_running:
+            self.is_running = True
+            with receivers_lock:
+                active_receivers.append(self)
+            start_receiver_reaper()
+            get_engine().subscribe(self.host, self.key, self.my_queue)
+
+    def stop(self):
+        if self.is_running:
+            self.is_running = False
+            get_engine().unsubscribe(self.host, self.key, self.my_queue)
+        with receivers_lock:
+            if self in active_receivers: active_receivers.remove(self)
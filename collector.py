@@ -0,0 +1,266 @@
+"""
+SHOWROOM 配信ログのヘッドレス収集デーモン
+
+ブラウザを開かずに複数ルームのコメント・スペシャルギフト・無償ギフト・システムMSGを収集し、
+100件ごとの自動保存と配信終了時の最終保存をFTPへ行う。
+ログの行はルームごとのジャーナル（event_store.py）に追記され、ギフトリスト・ファンリスト等と
+ジャーナルの場所は COLLECTOR_OUTPUT_DIR にルームごとのスナップショット(JSON)として書き出される。
+app.py はスナップショットを読み、ジャーナルの新しい行だけを追いかけて読み取り専用で表示する。
+
+使い方:
+    python collector.py 154851 123456
+    python collector.py --rooms-file rooms.txt
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from free_gift_handler import create_receiver, get_streaming_server_info, drain_queue, ingest_raw_batch
+from showroom_api import get_onlives_rooms, get_and_update_log, get_gift_list, get_free_gift_master, get_fan_list
+from event_store import open_room_logs
+from ftp_writer import ftp_uploader, create_segmented_exports
+
+COLLECTOR_OUTPUT_DIR = os.environ.get("SR_COLLECTOR_DIR", "collector_output")
+POLL_INTERVAL = 10
+# 配信中なのにハートビートが「周回間隔 × この回数」以上更新されていなければ、コレクター停止とみなす
+SNAPSHOT_STALE_TICKS = 3
+
+
+def snapshot_path(room_id):
+    return os.path.join(COLLECTOR_OUTPUT_DIR, f"{room_id}.json")
+
+
+def heartbeat_path(room_id):
+    """
+    収集中は毎周回更新するファイル。中身は実際の周回間隔（秒。--interval と周回にかかった時間の大きい方）。
+    スナップショット本体はギフトリスト等に変化があった時だけ書き直す
+    """
+    return os.path.join(COLLECTOR_OUTPUT_DIR, f"{room_id}.alive")
+
+
+def last_heartbeat(room_id):
+    try:
+        return os.path.getmtime(heartbeat_path(room_id))
+    except OSError:
+        return None
+
+
+def snapshot_stale_sec(room_id):
+    """ハートビートがこの秒数以上止まっていたらコレクター停止とみなす（コレクターの周回間隔から決める）"""
+    try:
+        with open(heartbeat_path(room_id), encoding="utf-8") as f:
+            interval = float(f.read())
+    except (OSError, ValueError):
+        interval = POLL_INTERVAL
+    return SNAPSHOT_STALE_TICKS * interval
+
+
+def load_snapshot(room_id):
+    """コレクターが書き出したスナップショットを読む。存在しない・配信中なのに古すぎる場合は None"""
+    try:
+        with open(snapshot_path(room_id), encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    heartbeat = max(last_heartbeat(room_id) or 0, snapshot.get("updated_at", 0))
+    if snapshot.get("is_live") and time.time() - heartbeat > snapshot_stale_sec(room_id):
+        return None
+    return snapshot
+
+
+def load_live_snapshot(room_id):
+    """コレクターが今まさに収集中のルームのスナップショット。配信終了後・停止中のものは None"""
+    snapshot = load_snapshot(room_id)
+    return snapshot if snapshot is not None and snapshot.get("is_live") else None
+
+
+class RoomCollector:
+    """1ルーム分の収集状態（app.py のセッション状態に相当）"""
+
+    def __init__(self, room_id, upload=True, engine=None, interval=POLL_INTERVAL):
+        self.room_id = str(room_id)
+        self.upload = upload
+        self.engine = engine
+        self.interval = interval
+        # 前回ハートビートを書いた時刻（実際の周回間隔を測る）
+        self.heartbeat_at = None
+        self.is_tracking = False
+        self.receiver = None
+        self.journal = None
+        # 前回書き出したスナップショットの中身の目印（変化が無ければ書き直さない）
+        self.snapshot_signature = None
+        self.reset()
+
+    def reset(self, live_id=None):
+        if self.journal:
+            self.journal.close()
+        # 同じ配信のジャーナルがあれば（デーモン再起動時）そこからログを復元する
+        logs, self.journal = open_room_logs(self.room_id, live_id)
+        # 配信終了で閉じた後もスナップショットに書けるよう、場所を覚えておく
+        self.journal_path = self.journal.path if self.journal else None
+        self.comment_log = logs["comment"]
+        self.gift_log = logs["gift"]
+        self.free_gift_log = logs["free_gift"]
+        self.system_msg_log = logs["system_msg"]
+        self.gift_list_map = {}
+        self.free_gift_master = {}
+        self.fan_list = []
+        self.total_fan_count = 0
+        self.exports = create_segmented_exports(self.room_id, lambda: self.gift_list_map, logs)
+
+    def tick(self, is_live):
+        try:
+            if is_live and not self.is_tracking:
+                self.start()
+            elif not is_live and self.is_tracking:
+                self.finish()
+            if self.is_tracking:
+                self.poll()
+        except Exception as e:
+            print(f"Collector Error (room {self.room_id}): {e}")
+
+    def start(self):
+        streaming_info = get_streaming_server_info(self.room_id)
+        if not streaming_info:
+            # まだ配信サーバー情報が取れない場合は次の周回で再試行
+            return
+        self.reset(streaming_info.get("live_id"))
+        self.free_gift_master = get_free_gift_master(self.room_id) or {}
+        self.receiver = create_receiver(
+            room_id=self.room_id,
+            host=streaming_info["host"],
+            key=streaming_info["key"],
+            engine=self.engine
+        )
+        self.receiver.start()
+        self.is_tracking = True
+        print(f"Tracking started: Room {self.room_id}")
+
+    def poll(self):
+        self.comment_log = get_and_update_log("comment", self.room_id, self.comment_log)
+        self.gift_log = get_and_update_log("gift", self.room_id, self.gift_log)
+        self.gift_list_map = get_gift_list(self.room_id) or self.gift_list_map
+        self.fan_list, self.total_fan_count = get_fan_list(self.room_id)
+        self.drain_queue()
+        if self.journal:
+            self.journal.sync()
+        self.autosave()
+        self.write_snapshot(is_live=True)
+
+    def drain_queue(self):
+        raw_items = drain_queue(self.receiver.my_queue)
+        ingest_raw_batch(raw_items, self.free_gift_master, self.free_gift_log, self.system_msg_log)
+
+    def autosave(self):
+        """app.py と同じく、各ログが次の100の倍数に達したら前回以降の追加分をFTPへ保存"""
+        if not self.upload:
+            return
+        for log_type in ["comment", "gift", "free_gift", "system_msg"]:
+            self.exports[log_type].checkpoint_if_due(getattr(self, f"{log_type}_log"))
+
+    def finish(self):
+        """配信終了またはデーモン停止時の最終保存"""
+        if self.receiver:
+            self.receiver.stop()
+            self.drain_queue()
+            self.receiver = None
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+        if self.upload:
+            for log_type, exporter in self.exports.items():
+                exporter.finish(getattr(self, f"{log_type}_log"))
+        self.is_tracking = False
+        self.write_snapshot(is_live=False)
+        print(f"Tracking finished: Room {self.room_id}")
+
+    def write_heartbeat(self):
+        """ハートビートを更新し、実際の周回間隔を書いておく（閲覧側はこれから停止の判定時間を決める）"""
+        now = time.time()
+        interval = self.interval
+        if self.heartbeat_at is not None:
+            interval = max(interval, now - self.heartbeat_at)
+        self.heartbeat_at = now
+        with open(heartbeat_path(self.room_id), "w", encoding="utf-8") as f:
+            f.write(f"{interval:.1f}")
+
+    def write_snapshot(self, is_live):
+        os.makedirs(COLLECTOR_OUTPUT_DIR, exist_ok=True)
+        self.write_heartbeat()
+        # ログの行はジャーナルに追記済みなので、スナップショットにはジャーナルの場所だけを書く
+        # （閲覧側は新しい行だけを読む）。ジャーナルが使えない場合だけログ全体を書く
+        journal_path = self.journal_path
+        logs = [self.comment_log, self.gift_log, self.free_gift_log, self.system_msg_log]
+        signature = (
+            is_live, journal_path, None if journal_path else [(log.serial, log.added) for log in logs],
+            id(self.gift_list_map), id(self.fan_list), self.total_fan_count,
+        )
+        if signature == self.snapshot_signature:
+            return
+        self.snapshot_signature = signature
+        snapshot = {
+            "room_id": self.room_id,
+            "is_live": is_live,
+            "updated_at": time.time(),
+            "journal": journal_path,
+            "gift_list_map": self.gift_list_map,
+            "fan_list": self.fan_list,
+            "total_fan_count": self.total_fan_count,
+        }
+        if not journal_path:
+            for log_type in ["comment", "gift", "free_gift", "system_msg"]:
+                snapshot[f"{log_type}_log"] = list(getattr(self, f"{log_type}_log"))
+        # 閲覧側が書きかけのファイルを読まないよう、一時ファイルに書いてから置き換える
+        path = snapshot_path(self.room_id)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+def read_room_ids(args):
+    room_ids = list(args.room_ids)
+    if args.rooms_file:
+        with open(args.rooms_file, encoding="utf-8") as f:
+            room_ids.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+    # 重複を除きつつ指定順を維持
+    return [r for r in dict.fromkeys(room_ids) if r.isdigit()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SHOWROOM 配信ログのヘッドレス収集デーモン")
+    parser.add_argument("room_ids", nargs="*", help="収集対象のルームID")
+    parser.add_argument("--rooms-file", help="ルームIDを1行に1つ書いたファイル")
+    parser.add_argument("--interval", type=int, default=POLL_INTERVAL, help="ポーリング間隔（秒）")
+    parser.add_argument("--workers", type=int, default=16, help="同時にポーリングするルーム数")
+    parser.add_argument("--no-ftp", action="store_true", help="FTPへの保存を行わない")
+    parser.add_argument("--engine", choices=["thread", "asyncio"], help="WebSocket受信エンジン（既定は SR_RECEIVER_ENGINE）")
+    args = parser.parse_args()
+
+    room_ids = read_room_ids(args)
+    if not room_ids:
+        parser.error("ルームIDを1つ以上指定してください。")
+
+    collectors = [RoomCollector(room_id, upload=not args.no_ftp, engine=args.engine, interval=args.interval) for room_id in room_ids]
+    print(f"Collector started: {len(collectors)} rooms")
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        try:
+            while True:
+                started = time.time()
+                onlives = get_onlives_rooms()
+                # onlives の取得に失敗した周回で全ルームを「配信終了」扱いにしない
+                if onlives:
+                    list(pool.map(lambda c: c.tick(int(c.room_id) in onlives), collectors))
+                time.sleep(max(0, args.interval - (time.time() - started)))
+        except KeyboardInterrupt:
+            print("Collector stopping: saving logs...")
+            list(pool.map(lambda c: c.finish(), [c for c in collectors if c.is_tracking]))
+            # FTPへのアップロードはバックグラウンドで行われるので、終わるまで待ってから終了する
+            ftp_uploader.join()
+
+
+if __name__ == "__main__":
+    main()
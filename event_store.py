@@ -0,0 +1,497 @@
+import glob
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from array import array
+
+from showroom_api import format_jst, is_system_comment
+
+# ジャーナルの書き込み権のロック。fcntl が無い環境ではロックしない（同じ配信を複数タブで記録すると行が混ざりうる）
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# --- ルーム単位のログ保持（app.py のセッション状態 / collector.py の RoomCollector 共通） ---
+# APIの返却そのままの dict をリストで持つと、使わない項目や同じユーザー名の文字列が行ごとに残り、
+# 長時間の配信では1ワーカーあたり数百MBになる。そこで表示・保存に使う項目だけを列ごとに持ち、
+# 数値は型付き配列、ユーザー名・ギフト名・ID などはルーム内で共有する値表への番号として保持する。
+
+# ログ種別ごとに保持する項目
+#   "int"   : 型付き配列（array('q')）。created_at / num / point
+#   "value" : 値表（ValueTable）への番号（array('I')）。繰り返し現れる名前・ID・画像URL
+#   "text"  : 文字列のリスト。コメント本文など行ごとにほぼ異なるもの
+#   "jst"   : created_at から取り込み時に1回だけ作る日本時間の文字列（値表に保持）。表示・保存はこれを使う
+LOG_FIELDS = {
+    "comment": {
+        "created_at": "int", "time": "jst", "user_id": "value", "name": "value", "comment": "text", "avatar_url": "value",
+    },
+    "gift": {
+        "created_at": "int", "time": "jst", "user_id": "value", "name": "value", "avatar_id": "value",
+        "gift_id": "value", "gift_name": "value", "point": "int", "num": "int", "image": "value",
+    },
+    "free_gift": {
+        "created_at": "int", "time": "jst", "user_id": "value", "name": "value", "avatar_id": "value",
+        "gift_id": "value", "gift_name": "value", "point": "int", "num": "int", "image": "value",
+    },
+    "system_msg": {
+        "created_at": "int", "time": "jst", "user_id": "value", "message": "text",
+    },
+}
+# 無償ギフト・システムMSG（WebSocketで大量に届くログ）に保持する最大行数。0 なら上限なし。
+# 上限を超えた古い行は画面・差分保存の対象から外れる（ジャーナルと GiftTally の累計には残る）ので、
+# 差分保存（100件ごと）より十分大きな値にすること
+WS_LOG_MAX_ROWS = int(os.environ.get("SR_WS_LOG_MAX_ROWS", "0"))
+# "int" 列で値が無いことを表す番号
+MISSING_INT = -(2 ** 63)
+# ログごとの通し番号（イベントID = (ログの番号, 受信番号) をプロセス内で一意にする）
+log_serials = itertools.count(1)
+
+
+def log_key(row):
+    """コメント・ギフトログの重複判定キー（従来と同じく created_at と name の組）"""
+    return (row.get('created_at'), row.get('name'))
+
+
+class ValueTable:
+    """繰り返し現れる値を1つだけ保持し、番号で参照できるようにする（番号 0 は「値なし」）"""
+
+    def __init__(self):
+        self.values = [None]
+        # (型, 値) -> 番号。1 と "1" を別の値として扱う
+        self.numbers = {}
+        self.lock = threading.Lock()
+
+    def intern(self, value):
+        if value is None:
+            return 0
+        key = (type(value), value)
+        number = self.numbers.get(key)
+        if number is None:
+            with self.lock:
+                number = self.numbers.get(key)
+                if number is None:
+                    number = len(self.values)
+                    self.values.append(value)
+                    self.numbers[key] = number
+        return number
+
+
+class GiftTally:
+    """
+    ギフトログの累計。(ユーザーID, ギフトID) ごとの合計個数・最新時刻と、ユーザーごとの最新の名前を
+    行の追加時に更新しておくので、ランキング・合算表は全件ではなく組の数に比例する手間で作れる。
+    """
+
+    def __init__(self, rows=()):
+        # (ユーザーID, ギフトID) -> {"num", "created_at", "gift_name", "point"}
+        self.pairs = {}
+        # ユーザーID -> (created_at, 名前)
+        self.names = {}
+        for row in rows:
+            self.add(row)
+
+    def add(self, row):
+        user_id = row.get("user_id")
+        if user_id is None:
+            return
+        created_at = row.get("created_at") or 0
+        key = (user_id, str(row.get("gift_id")))
+        pair = self.pairs.get(key)
+        if pair is None:
+            pair = self.pairs[key] = {"num": 0, "created_at": 0, "gift_name": None, "point": None}
+        if pair["gift_name"] is None and row.get("gift_name") is not None:
+            # 取り込み時にギフト名が付かなかったギフトは、付いた行が来た時点で埋める
+            pair["gift_name"], pair["point"] = row["gift_name"], row.get("point")
+        pair["num"] += int(row.get("num") or 0)
+        if created_at >= pair["created_at"]:
+            pair["created_at"] = created_at
+        latest = self.names.get(user_id)
+        if latest is None or created_at >= latest[0]:
+            self.names[user_id] = (created_at, row.get("name"))
+
+
+def tally_groups(sources):
+    """
+    (GiftTally, resolve) のリストから (ユーザーID, ギフト名, ポイント) ごとの集計を作る。
+    resolve(gift_id, pair) は (ギフト名, ポイント) を返し、分からないギフトは None（集計から除く）。
+    戻り値の各要素: {"user_id", "name", "gift_name", "point", "num", "created_at"}
+    """
+    groups = {}
+    names = {}
+    for tally, resolve in sources:
+        for (user_id, gift_id), pair in tally.pairs.items():
+            resolved = resolve(gift_id, pair)
+            if resolved is None:
+                continue
+            gift_name, point = resolved
+            group = groups.get((user_id, gift_name, point))
+            if group is None:
+                group = groups[(user_id, gift_name, point)] = {
+                    "user_id": user_id, "gift_name": gift_name, "point": point, "num": 0, "created_at": 0,
+                }
+            group["num"] += pair["num"]
+            group["created_at"] = max(group["created_at"], pair["created_at"])
+        for user_id, latest in tally.names.items():
+            if user_id not in names or latest[0] >= names[user_id][0]:
+                names[user_id] = latest
+    for group in groups.values():
+        group["name"] = names[group["user_id"]][1]
+    return list(groups.values())
+
+
+class EventLog:
+    """
+    新しい順に並んだログ。list と同じく len() / for / [i] / pd.DataFrame(...) で扱え、各行は dict として取り出せる。
+    中身は受信順の列（LOG_FIELDS）として持ち、since(n) で「n件目以降に追加された行」を取り出せる（差分保存用）。
+    max_rows を指定すると、それを超えた分は受信の古い行からまとめて捨てる（1行あたりの手間は O(1) のまま）。
+    ただし keep_from 以降の行（差分保存がまだ書き出していない行）は上限を超えても捨てない。
+    """
+
+    def __init__(self, kind, rows=(), values=None, max_rows=None):
+        self.kind = kind
+        self.serial = next(log_serials)
+        self.fields = LOG_FIELDS[kind]
+        # 値表は open_room_logs() でルーム内の4種類のログに共有される
+        self.values = values if values is not None else ValueTable()
+        self.columns = {
+            name: array("q") if codec == "int" else array("I") if codec in ("value", "jst") else []
+            for name, codec in self.fields.items()
+        }
+        # 受信番号を新しい順の逆（古い順）に並べたもの。末尾が最新なので通常の追加は append で済む
+        self.order = array("I")
+        # これまでに追加した行数（受信番号の次の値）
+        self.added = 0
+        # 列に残っている最も古い受信番号（max_rows で古い行を捨てると進む）
+        self.base = 0
+        self.max_rows = max_rows or None
+        # 差分保存がまだ書き出していない最初の受信番号（SegmentedExport が設定する。None なら制限なし）
+        self.keep_from = None
+        # 追加した行を書き出すジャーナル（open_room_logs() で設定される）
+        self.journal = None
+        # ギフトログはユーザー×ギフトの累計も追加のたびに更新する
+        self.tally = GiftTally() if kind in ("gift", "free_gift") else None
+        for row in rows:
+            self.add(row)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        for number in reversed(self.order):
+            yield self.row(number)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self.order)
+        if not 0 <= index < len(self.order):
+            raise IndexError("log index out of range")
+        return self.row(self.order[len(self.order) - 1 - index])
+
+    def row(self, number):
+        """受信番号 number の行を dict に戻す（値の無い項目はキーごと省く）"""
+        row = {}
+        index = number - self.base
+        for name, codec in self.fields.items():
+            value = self.columns[name][index]
+            if codec == "int":
+                if value != MISSING_INT:
+                    row[name] = value
+            elif codec in ("value", "jst"):
+                if value:
+                    row[name] = self.values.values[value]
+            elif value is not None:
+                row[name] = value
+        return row
+
+    def add(self, row):
+        """1行を新しい順を保って追加する（通常は末尾への O(1) の追加）。LOG_FIELDS 以外の項目は保持しない"""
+        number = self.added
+        for name, codec in self.fields.items():
+            value = row.get(name)
+            if codec == "int":
+                self.columns[name].append(MISSING_INT if value is None else int(value))
+            elif codec == "value":
+                self.columns[name].append(self.values.intern(value))
+            elif codec == "jst":
+                self.columns[name].append(self.values.intern(format_jst(row.get("created_at") or 0)))
+            else:
+                self.columns[name].append(value)
+        self.added += 1
+        if self.tally is not None:
+            self.tally.add(row)
+
+        created_at = self._created_at(number)
+        if not self.order or created_at >= self._created_at(self.order[-1]):
+            self.order.append(number)
+        else:
+            self._insert_late(number, created_at)
+        if self.journal is not None:
+            self.journal.append(self.kind, self.row(number))
+        # 上限の 1/4 だけ余分に溜めてからまとめて捨てるので、列の詰め直しは追加 1 行あたり O(1)
+        if self.max_rows and len(self.order) > self.max_rows + max(1, self.max_rows // 4):
+            self._trim()
+
+    def newest(self, count):
+        """新しい順に最大 count 件の (イベントID, 行)。同じイベントIDの行の内容は変わらない（表示のキャッシュ用）"""
+        start = max(0, len(self.order) - count)
+        return [((self.serial, number), self.row(number)) for number in reversed(self.order[start:])]
+
+    def since(self, count):
+        """受信順で count 件目より後に追加された行（古い順）。max_rows で捨てた行は含まない"""
+        return [self.row(number) for number in range(max(count, self.base), self.added)]
+
+    def _trim(self):
+        """受信の新しい max_rows 行だけを残す（keep_from 以降のまだ保存していない行は残す）"""
+        base = self.added - self.max_rows
+        if self.keep_from is not None:
+            base = min(base, self.keep_from)
+        cut = base - self.base
+        if cut <= 0:
+            return
+        for column in self.columns.values():
+            del column[:cut]
+        self.order = array("I", (number for number in self.order if number >= base))
+        self.base = base
+
+    def _created_at(self, number):
+        value = self.columns["created_at"][number - self.base]
+        return 0 if value == MISSING_INT else value
+
+    def _insert_late(self, number, created_at):
+        """既存の最新行より古い行が遅れて届いた場合（稀）は、同時刻の行より古い側に挿入する"""
+        position = len(self.order)
+        while position > 0 and self._created_at(self.order[position - 1]) >= created_at:
+            position -= 1
+        self.order.insert(position, number)
+
+
+class RoomLog(EventLog):
+    """
+    重複判定つきのログ（コメント・スペシャルギフト）。重複判定用のキー集合を持ち続けるので、
+    ポーリングのたびに全件からキー集合を作り直したり全件を再ソートしたりせず、新着 k 件を O(k) でマージできる。
+    """
+
+    def __init__(self, kind, rows=(), values=None):
+        self.keys = set()
+        super().__init__(kind, values=values)
+        self.merge(rows)
+
+    def merge(self, new_rows, enrich=None):
+        """
+        未取得の行だけを新しい順を保ったまま追加し、追加した行（新しい順）を返す。
+        enrich(row) を渡すと、追加する行にだけ呼んでから取り込む（ギフト名などの付与用）
+        """
+        fresh = []
+        for row in new_rows:
+            key = log_key(row)
+            if key not in self.keys:
+                self.keys.add(key)
+                if enrich is not None:
+                    enrich(row)
+                fresh.append(row)
+        if not fresh:
+            return fresh
+
+        # APIの返却は通常新しい順だが念のため新着分だけ並べ直す（同時刻の行は返却順を維持）
+        fresh.sort(key=lambda x: x.get('created_at', 0), reverse=True)
+        for row in reversed(fresh):
+            self.add(row)
+        return fresh
+
+
+class CommentLog(RoomLog):
+    """
+    コメントログ。運営・システムのコメント（is_system_comment）は取り込み時に system_comments へ振り分け、
+    本体には視聴者のコメントだけを持つ。表示・保存のたびにキーワードで全件を絞り込み直さずに済む。
+    """
+
+    def __init__(self, rows=(), values=None):
+        self.system_comments = EventLog("comment", values=values)
+        super().__init__("comment", rows, values)
+
+    def add(self, row):
+        if is_system_comment(row):
+            self.system_comments.add(row)
+        else:
+            super().add(row)
+
+
+# --- ローカルの追記専用ジャーナル ---
+# 取り込んだ行をすべて JSON Lines で追記しておき、リロードやプロセスの再起動後に
+# APIを呼び直さずにログを復元する。fsync は毎行ではなくまとめて行う。
+
+JOURNAL_DIR = os.environ.get("SR_JOURNAL_DIR", "journal")
+# この行数がたまったら sync() を待たずに fsync する
+JOURNAL_SYNC_EVERY = 200
+# これより古いジャーナルは新しいジャーナルを開くときに削除する
+JOURNAL_RETENTION_SEC = 48 * 3600
+LOG_KINDS = ["comment", "gift", "free_gift", "system_msg"]
+
+
+class EventJournal:
+    """
+    1ルーム・1配信分のジャーナルファイル。append() はバッファに書き、sync() でディスクに確定する。
+    開いている間はファイルを排他ロックし、他のタブ・プロセスが同じファイルに追記できないようにする
+    （ロック中のファイルを開こうとすると OSError）
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a", encoding="utf-8")
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self.file.close()
+                raise
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def append(self, kind, row):
+        line = json.dumps({"k": kind, "r": row}, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.pending += 1
+            if self.pending >= JOURNAL_SYNC_EVERY:
+                self._sync()
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        if self.pending and not self.file.closed:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            self.file.close()
+
+
+def journal_pattern(room_id, live_id):
+    return os.path.join(JOURNAL_DIR, f"{room_id}_{live_id}_*.jsonl")
+
+
+def remove_expired_journals():
+    cutoff = time.time() - JOURNAL_RETENTION_SEC
+    for path in glob.glob(os.path.join(JOURNAL_DIR, "*.jsonl")):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def replay_lines(lines, logs, out=None):
+    """ジャーナルの行を logs に追加する。out を渡すと読めた行をそのまま書き写す。追加した行数を返す"""
+    count = 0
+    for line in lines:
+        try:
+            record = json.loads(line)
+            log = logs[record["k"]]
+        except (ValueError, KeyError):
+            continue
+        if isinstance(log, RoomLog):
+            log.merge([record["r"]])
+        else:
+            log.add(record["r"])
+        if out is not None:
+            out.write(line if line.endswith("\n") else line + "\n")
+        count += 1
+    return count
+
+
+def replay_journal(path, logs, out=None):
+    """ジャーナルを読み込んで logs に復元する。out を渡すと読めた行をそのまま書き写す（書きかけの末尾行は捨てる）"""
+    with open(path, encoding="utf-8") as f:
+        return replay_lines(f, logs, out)
+
+
+class JournalTail:
+    """
+    他のプロセス（collector.py）が書いているジャーナルを読み取り専用で追いかける。
+    poll() は前回読んだ位置より後に確定した行だけを logs に追加するので、手間は新しい行の数に比例する
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.logs = new_room_logs()
+
+    def poll(self):
+        """新しく書かれた行を取り込み、その行数を返す（書きかけの末尾行は次回に回す）"""
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self.offset)
+                data = f.read()
+        except OSError:
+            return 0
+        end = data.rfind(b"\n") + 1
+        if not end:
+            return 0
+        self.offset += end
+        return replay_lines(data[:end].decode("utf-8").splitlines(True), self.logs)
+
+
+def new_room_logs():
+    """4種類のログ（comment / gift / free_gift / system_msg）を、ユーザー名などの値表を共有して作る"""
+    values = ValueTable()
+    return {
+        "comment": CommentLog(values=values),
+        "gift": RoomLog("gift", values=values),
+        "free_gift": EventLog("free_gift", values=values, max_rows=WS_LOG_MAX_ROWS),
+        "system_msg": EventLog("system_msg", values=values, max_rows=WS_LOG_MAX_ROWS),
+    }
+
+
+def open_room_logs(room_id, live_id):
+    """
+    4種類のログ（comment / gift / free_gift / system_msg）をジャーナルつきで作る。
+    同じ配信のジャーナルが残っていれば（リロード・再起動時）そこから復元する。
+    戻り値: (logs, journal)。live_id が分からない場合はジャーナルを使わず journal は None
+    """
+    logs = new_room_logs()
+    if not live_id:
+        return logs, None
+
+    try:
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        remove_expired_journals()
+        previous = sorted(glob.glob(journal_pattern(room_id, live_id)), key=os.path.getmtime)
+        journal = None
+        if previous:
+            # 直近のジャーナルを誰も書いていなければ、そのまま復元して追記を続ける（書き写さない）
+            try:
+                journal = EventJournal(previous[-1])
+            except OSError:
+                journal = None
+            if journal is not None:
+                restored = replay_journal(previous[-1], logs)
+                print(f"Journal restored: Room {room_id} ({restored} rows from {previous[-1]})")
+        if journal is None:
+            # 初回、または同じ配信を別タブ・別プロセスが記録中の場合は新しいファイルに記録する。
+            # 記録中のジャーナルは書き込みが混ざらないよう、新しいファイルに書き写して引き継ぐ
+            path = os.path.join(JOURNAL_DIR, f"{room_id}_{live_id}_{uuid.uuid4().hex[:8]}.jsonl")
+            journal = EventJournal(path)
+            if previous:
+                restored = replay_journal(previous[-1], logs, journal.file)
+                journal.pending = restored
+                journal.sync()
+                print(f"Journal restored: Room {room_id} ({restored} rows copied from {previous[-1]})")
+    except OSError as e:
+        print(f"Journal Error (room {room_id}): {e}")
+        return logs, None
+
+    # システムコメントも "comment" として記録し、復元時に CommentLog が振り分け直す
+    for log in [*logs.values(), logs["comment"].system_comments]:
+        log.journal = journal
+    return logs, journal
@@ -1,9 +1,13 @@
 import websocket
 import json
+import re
+import tempfile
 import threading
-import requests
+from showroom_api import api_get
 import queue
 import time
+import datetime
+import os
 import streamlit as st
 
 # --- 修正の要：グローバルな gift_queue は使わず、セッションごとにキューを管理する ---
@@ -11,43 +15,354 @@ import streamlit as st
 active_receivers = []
 receivers_lock = threading.Lock()
 
+# 受信エンジンの切り替え："thread"（websocket-client）または "asyncio"（async_receiver.py）
+RECEIVER_ENGINE = os.environ.get("SR_RECEIVER_ENGINE", "thread")
+# 1本の接続で購読するキー（ルーム）数の上限。超えたら同じホストに別の接続を張る
+MAX_KEYS_PER_CONNECTION = 200
+# 画面の1回の更新でキューから取り出す最大件数（残りは次の更新で取り出す）
+DRAIN_BATCH_SIZE = 5000
+# 同じユーザーの同じギフト (t=2) がこの秒数以内に続けて届いたら、キューの中で1件にまとめて個数 n を合算する。
+# 0 ならまとめない（1フレーム = 1行）
+COALESCE_WINDOW_SEC = float(os.environ.get("SR_COALESCE_WINDOW_SEC", "0"))
+# 受信機ごとのキューにメモリ上で溜めておく最大件数（0 なら上限なし）と、溢れたときの方針（FrameQueue 参照）
+FRAME_QUEUE_MAX_SIZE = int(os.environ.get("SR_FRAME_QUEUE_MAX_SIZE", "50000"))
+FRAME_QUEUE_OVERFLOW = os.environ.get("SR_FRAME_QUEUE_OVERFLOW", "coalesce")
+# セッションが終わった（タブを閉じた）のに停止されていない受信機を探す間隔（秒）
+RECEIVER_REAP_INTERVAL_SEC = 60
+
+
+# JSON のデコードは orjson があればそちらを使う（無ければ標準の json）。SR_JSON_BACKEND=json で標準に固定できる
+try:
+    if os.environ.get("SR_JSON_BACKEND", "orjson") != "orjson":
+        raise ImportError
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# 受け取るフレームの種類：ギフト (2) とシステムメッセージ (18)
+KEPT_FRAME_TYPES = {"2", "18"}
+# JSON 全体をデコードする前に "t" の値だけを覗く。文字列中の \"t\" はエスケープされているので一致しない。
+# 入れ子のオブジェクト・配列の "t" と区別するため、最初の { から一致した位置までに { や [ が無い場合だけ信用する
+FRAME_TYPE_PATTERN = re.compile(r'(?<!\\)"t"\s*:\s*"?(\d+)')
+
+
+def peek_frame_type(payload):
+    """
+    トップレベルの "t" の値を JSON をデコードせずに返す。
+    見つからない・入れ子の中かもしれない等で確かでない場合は None（呼び出し側で全体をデコードする）
+    """
+    peeked = FRAME_TYPE_PATTERN.search(payload)
+    if peeked is None:
+        return None
+    start = payload.find("{")
+    prefix = payload[start + 1:peeked.start()]
+    if start < 0 or "{" in prefix or "[" in prefix:
+        return None
+    return peeked.group(1)
+
+
+def repair_mojibake(text):
+    """UTF-8 のバイト列を latin-1 として読んでしまった文字列だけを元に戻す。正しい文字列はそのまま返す"""
+    if not text or text.isascii() or max(text) > "\xff":
+        return text
+    try:
+        return text.encode("latin-1").decode("utf-8")
+    except UnicodeDecodeError:
+        return text
+
+
+def parse_frame(message):
+    """
+    「MSG\t{key}\t{json}」形式のフレームを解析する。
+    ギフト (t=2) / システムメッセージ (t=18) のみ (key, data) を返し、それ以外は None。
+    コメント等の捨てるフレームは "t" の値だけを見て、JSON 全体はデコードしない
+    """
+    if not message.startswith("MSG"):
+        return None
+    parts = message.split("\t", 2)
+    if len(parts) < 3: return None
+    peeked = peek_frame_type(parts[2])
+    if peeked is not None and peeked not in KEPT_FRAME_TYPES:
+        return None
+    data = json_loads(parts[2])
+
+    # tの値を取得（念のため文字列として比較）
+    msg_type = str(data.get("t"))
+    if msg_type not in KEPT_FRAME_TYPES:
+        return None
+
+    # システムメッセージは文字化けしている場合だけ修復する
+    if msg_type == "18":
+        data["m"] = repair_mojibake(data.get("m", ""))
+    return parts[1], data
+
+
+class FrameQueue(queue.Queue):
+    """
+    受信機から画面・コレクターへ生データを渡すキュー。
+    window > 0 の場合、まだ取り出されていないギフト (t=2) に同じユーザー・同じギフトの
+    フレームが window 秒以内に届いたら、新しい行を積まずに個数 n を足し込む（合計個数は変わらない）。
+    メモリ上には max_size 件までしか持たず、溢れた分は overflow の方針で扱う（受信スレッドは待たせない）:
+      "coalesce" : 同じユーザー・同じギフトの未取り出しの行があれば時間に関係なく足し込み、無ければ捨てる
+      "spill"    : 一時ファイルに書き出し、メモリ上の行を取り出し終えたら順に読み戻す
+      "drop"     : 捨てる
+    まとめた件数・書き出した件数・捨てた件数は coalesced / spilled / dropped に数える
+    """
+
+    def __init__(self, window=None, max_size=None, overflow=None):
+        self.window = COALESCE_WINDOW_SEC if window is None else window
+        self.max_size = FRAME_QUEUE_MAX_SIZE if max_size is None else max_size
+        self.overflow = overflow or FRAME_QUEUE_OVERFLOW
+        self.coalesced = 0
+        self.spilled = 0
+        self.dropped = 0
+        # 溢れている間は True（溢れ始めに1回だけ出力するため）
+        self.overflowing = False
+        super().__init__()
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        # (ユーザーID, ギフトID) -> (まだキューにある行, 最初のフレームの受信時刻)
+        self.pending = {}
+        # "spill" で書き出した行の一時ファイル、未読の行数と読み出し位置
+        self.spill_file = None
+        self.spill_count = 0
+        self.spill_offset = 0
+
+    def _qsize(self):
+        return len(self.queue) + self.spill_count
+
+    def _put(self, item):
+        track = self.window > 0 or self.overflow == "coalesce"
+        key = coalesce_key(item) if track else None
+        now = time.monotonic()
+        entry = self.pending.get(key) if key is not None else None
+        if entry is not None and self.window > 0 and now - entry[1] <= self.window:
+            self._merge(entry[0], item)
+            return
+        if self.max_size and (self.spill_count or len(self.queue) >= self.max_size):
+            self._put_overflow(item, entry)
+            return
+        self.overflowing = False
+        if key is not None:
+            # 共有接続では同じ dict が複数のキューに入るので、足し込む前に写しを作る
+            item = dict(item)
+            self.pending[key] = (item, now)
+        self.queue.append(item)
+
+    def _put_overflow(self, item, entry):
+        if not self.overflowing:
+            self.overflowing = True
+            print(f"Frame Queue Overflow ({self.overflow}): {len(self.queue)} frames waiting")
+        if self.overflow == "coalesce" and entry is not None:
+            self._merge(entry[0], item)
+        elif self.overflow == "spill":
+            self._spill(item)
+        else:
+            self.dropped += 1
+
+    def _merge(self, target, item):
+        target["n"] = int(target.get("n") or 1) + int(item.get("n") or 1)
+        self.coalesced += 1
+
+    def _spill(self, item):
+        try:
+            if self.spill_file is None:
+                self.spill_file = tempfile.TemporaryFile("w+", encoding="utf-8")
+            self.spill_file.seek(0, os.SEEK_END)
+            self.spill_file.write(json.dumps(item, ensure_ascii=False) + "\n")
+            self.spill_count += 1
+            self.spilled += 1
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Frame Queue Spill Error: {e}")
+            self.dropped += 1
+
+    def _unspill(self):
+        """書き出した行を max_size 件まで（上限なしなら全件）メモリ上に読み戻す"""
+        self.spill_file.seek(self.spill_offset)
+        while self.spill_count and (not self.max_size or len(self.queue) < self.max_size):
+            line = self.spill_file.readline()
+            self.spill_count -= 1
+            try:
+                self.queue.append(json.loads(line))
+            except ValueError:
+                self.dropped += 1
+        self.spill_offset = self.spill_file.tell()
+        if not self.spill_count:
+            # 読み終えたら一時ファイルを捨てる
+            self.spill_file.close()
+            self.spill_file = None
+            self.spill_offset = 0
+
+    def _get(self):
+        if not self.queue:
+            self._unspill()
+        item = self.queue.popleft()
+        if self.pending:
+            key = coalesce_key(item)
+            entry = self.pending.get(key)
+            if entry is not None and entry[0] is item:
+                del self.pending[key]
+        return item
+
+
+def coalesce_key(data):
+    """まとめてよいフレームのキー。ギフト (t=2) 以外は None"""
+    if str(data.get("t")) != "2":
+        return None
+    return data.get("u"), data.get("g")
+
+
+class BroadcastClient:
+    """1つの bcsvr_host への共有接続。複数キーを SUB し、MSG をキーごとのキューへ振り分ける"""
+
+    def __init__(self, host):
+        self.host = host
+        self.ws = None
+        self.thread = None
+        self.is_running = False
+        self.is_connected = False
+        # key -> そのキーを購読しているキューのリスト（同じルームを複数タブで見る場合に対応）
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, key, target_queue):
+        # 接続済みかどうかは on_open と同じロックの中で見る。on_open がキーを写す前に追加したキーは
+        # on_open が、写した後に追加したキーはここで SUB するので、どちらにも漏れない
+        with self.lock:
+            is_new_key = key not in self.subscribers
+            self.subscribers.setdefault(key, []).append(target_queue)
+            send_now = is_new_key and self.is_connected
+        if send_now:
+            try:
+                self.ws.send(f"SUB\t{key}")
+            except Exception as e:
+                # 送れなかった分は再接続時の on_open でまとめて SUB される
+                print(f"WebSocket SUB Error: {e}")
+        if not self.is_running:
+            self.is_running = True
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def unsubscribe(self, key, target_queue):
+        """購読を外す。購読キーが無くなった場合は True を返す（接続は閉じる）"""
+        with self.lock:
+            queues = self.subscribers.get(key, [])
+            if target_queue in queues:
+                queues.remove(target_queue)
+            if not queues:
+                self.subscribers.pop(key, None)
+            is_empty = not self.subscribers
+        if is_empty:
+            self.is_running = False
+            if self.ws:
+                self.ws.close()
+        return is_empty
+
+    def on_message(self, ws, message):
+        try:
+            parsed = parse_frame(message)
+            if parsed is None:
+                return
+            key, data = parsed
+            with self.lock:
+                queues = list(self.subscribers.get(key, []))
+            for target_queue in queues:
+                target_queue.put(data)
+        except Exception as e:
+            print(f"WebSocket Message Error: {e}")
+
+    def on_error(self, ws, error):
+        print(f"WebSocket Error: {error}")
+
+    def on_close(self, ws, close_status_code, close_msg):
+        with self.lock:
+            self.is_connected = False
+        print(f"WebSocket Closed: {self.host}")
+
+    def on_open(self, ws):
+        # 再接続時も含め、現在の購読キーをすべて SUB し直す。
+        # キーの写しと接続済みフラグを同じロックの中で更新し、その間に追加されたキーを取りこぼさない
+        with self.lock:
+            keys = list(self.subscribers)
+            self.is_connected = True
+        for key in keys:
+            ws.send(f"SUB\t{key}")
+        print(f"WebSocket Connected: {self.host} ({len(keys)} rooms)")
+
+    def run(self):
+        ws_url = f"wss://{self.host}:443/"
+        while self.is_running:
+            try:
+                self.ws = websocket.WebSocketApp(
+                    ws_url,
+                    on_message=self.on_message,
+                    on_error=self.on_error,
+                    on_close=self.on_close,
+                    on_open=self.on_open
+                )
+                self.ws.run_forever(ping_interval=30, ping_timeout=10)
+            except Exception as e:
+                print(f"WebSocket Run Error: {e}")
+
+            if self.is_running:
+                time.sleep(5)
+
+
+# host -> BroadcastClient のリスト（プロセス内の全タブ・全ルームで共有）
+broadcast_clients = {}
+clients_lock = threading.Lock()
+
+
+def acquire_broadcast_client(host, key, target_queue):
+    """共有接続を選んで key を購読する。同じキーを購読済みの接続があればそれを優先する"""
+    with clients_lock:
+        clients = broadcast_clients.setdefault(host, [])
+        client = next((c for c in clients if key in c.subscribers), None)
+        if client is None:
+            client = next((c for c in clients if len(c.subscribers) < MAX_KEYS_PER_CONNECTION), None)
+        if client is None:
+            client = BroadcastClient(host)
+            clients.append(client)
+        client.subscribe(key, target_queue)
+        return client
+
+
+def release_broadcast_client(client, key, target_queue):
+    with clients_lock:
+        if client.unsubscribe(key, target_queue):
+            clients = broadcast_clients.get(client.host, [])
+            if client in clients:
+                clients.remove(client)
+            if not clients:
+                broadcast_clients.pop(client.host, None)
+
+
 class FreeGiftReceiver:
-    def __init__(self, room_id, host, key):
+    def __init__(self, room_id, host, key, shared=True):
         self.room_id = room_id
         self.host = host
         self.key = key
+        # shared=True の場合は同じホストの他ルームと1本の接続を共有する
+        self.shared = shared
+        self.client = None
         self.ws = None
         self.thread = None
         self.is_running = False
         # ★重要：このタブ専用のキューを作成
-        self.my_queue = queue.Queue()
+        self.my_queue = FrameQueue()
+        # 起動したブラウザタブのセッション（タブを閉じたら reap_abandoned_receivers() が停止する）
+        self.session_id = current_session_id()
 
     def on_message(self, ws, message):
-        if message.startswith("MSG"):
-            try:
-                parts = message.split("\t")
-                if len(parts) < 3: return
-                data = json.loads(parts[2])
-
-                # tの値を取得（念のため文字列として比較）
-                msg_type = str(data.get("t"))
-
-                # 🎁 ギフト (2) または ✅ システムメッセージ (18) の場合にキューへ入れる
-                if msg_type == "2" or msg_type == "18":
-                    
-                    # システムメッセージの場合は文字化け修復を試みる
-                    if msg_type == "18":
-                        try:
-                            raw_m = data.get("m", "")
-                            data["m"] = raw_m.encode('latin-1').decode('utf-8')
-                        except:
-                            pass
-                    
-                    # 以前のコードと同じく、データを専用の箱に入れる
-                    self.my_queue.put(data)
-
-            except Exception as e:
-                print(f"WebSocket Message Error: {e}")
+        try:
+            parsed = parse_frame(message)
+            if parsed is not None:
+                # 以前のコードと同じく、データを専用の箱に入れる
+                self.my_queue.put(parsed[1])
+        except Exception as e:
+            print(f"WebSocket Message Error: {e}")
 
     def on_error(self, ws, error):
         print(f"WebSocket Error: {error}")
@@ -82,15 +397,115 @@ class FreeGiftReceiver:
             self.is_running = True
             with receivers_lock:
                 active_receivers.append(self)
-            self.thread = threading.Thread(target=self.run, daemon=True)
-            self.thread.start()
+            start_receiver_reaper()
+            if self.shared:
+                self.client = acquire_broadcast_client(self.host, self.key, self.my_queue)
+            else:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
 
     def stop(self):
         self.is_running = False
+        if self.client:
+            release_broadcast_client(self.client, self.key, self.my_queue)
+            self.client = None
         if self.ws:
             self.ws.close()
         with receivers_lock:
-            if self: active_receivers.remove(self)
+            if self in active_receivers: active_receivers.remove(self)
+
+
+def current_session_id():
+    """実行中の Streamlit セッションのID。Streamlit の外（collector.py）では None"""
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx(suppress_warning=True)
+    except Exception:
+        return None
+    return ctx.session_id if ctx else None
+
+
+# 非公開APIでセッションを判定できなかったことを出力済みか（1回だけ出力する）
+session_check_failed = False
+
+
+def is_session_active(session_id):
+    """
+    セッションがまだ残っているか。判定できない場合は残っているものとみなす。
+    接続が一時的に切れただけのセッション（再接続で同じセッションに戻れる）は Streamlit の
+    セッション保管庫に残っているので、保管庫から消えた時だけ終わったとみなす
+    """
+    global session_check_failed
+    try:
+        from streamlit import runtime
+        if not runtime.exists():
+            return True
+        # 公開の Runtime.is_active_session() は接続が切れているだけのセッションも False を返すため、
+        # 再接続を待っているタブの受信機まで止めてしまう。保管庫を見るには非公開の _session_mgr を使うしかない
+        return runtime.get_instance()._session_mgr.get_session_info(session_id) is not None
+    except Exception as e:
+        # Streamlit の内部が変わるとここに来て、受信機の後始末が一切行われなくなる
+        if not session_check_failed:
+            session_check_failed = True
+            print(f"Receiver Reap Error: セッションの状態を確認できないため、受信機の後始末を行いません: {e}")
+        return True
+
+
+def reap_abandoned_receivers():
+    """停止されないままセッションが終わった受信機を停止し、active_receivers から外す。停止した数を返す"""
+    with receivers_lock:
+        abandoned = [r for r in active_receivers if r.session_id and not is_session_active(r.session_id)]
+    for receiver in abandoned:
+        try:
+            receiver.stop()
+        except Exception as e:
+            print(f"Receiver Reap Error: {e}")
+        # stop() が途中で失敗しても一覧からは必ず外す
+        with receivers_lock:
+            if receiver in active_receivers: active_receivers.remove(receiver)
+    if abandoned:
+        print(f"Receivers reaped: {len(abandoned)} (active {len(active_receivers)})")
+    return len(abandoned)
+
+
+reaper_thread = None
+
+
+def start_receiver_reaper():
+    """受信機の後始末を RECEIVER_REAP_INTERVAL_SEC ごとに行うスレッドを（プロセスで1本だけ）起動する"""
+    global reaper_thread
+    with receivers_lock:
+        if reaper_thread is not None:
+            return
+
+        def reap_forever():
+            while True:
+                time.sleep(RECEIVER_REAP_INTERVAL_SEC)
+                try:
+                    reap_abandoned_receivers()
+                except Exception as e:
+                    print(f"Receiver Reap Error: {e}")
+
+        reaper_thread = threading.Thread(target=reap_forever, daemon=True)
+        reaper_thread.start()
+
+
+def create_receiver(room_id, host, key, engine=None):
+    """設定されたエンジンの受信機を作る。どちらも start()/stop()/my_queue を持つ"""
+    if (engine or RECEIVER_ENGINE) == "asyncio":
+        from async_receiver import AsyncFreeGiftReceiver
+        return AsyncFreeGiftReceiver(room_id, host, key)
+    return FreeGiftReceiver(room_id, host, key)
+
+def drain_queue(target_queue, limit=None):
+    """キューに溜まった生データを最大 limit 件（None なら全件）まとめて取り出す"""
+    items = []
+    while limit is None or len(items) < limit:
+        try:
+            items.append(target_queue.get_nowait())
+        except queue.Empty:
+            break
+    return items
 
 # --- 本体側の「gift_queue」という名前に対応するためのダミーオブジェクト ---
 # 本体側が「from free_gift_handler import gift_queue」していてもエラーにならないようにします
@@ -108,48 +523,83 @@ class QueueProxy:
             return receiver.my_queue.get_nowait()
         raise queue.Empty
 
+    def drain(self, limit=DRAIN_BATCH_SIZE):
+        receiver = st.session_state.get("ws_receiver")
+        if receiver and hasattr(receiver, 'my_queue'):
+            return drain_queue(receiver.my_queue, limit)
+        return []
+
 # 本体側が「gift_queue」としてインポートして使うための実体
 gift_queue = QueueProxy()
 
-# --- 以下の関数は元のロジックと一文字一句変えていません ---
-
 def get_streaming_server_info(room_id):
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-    }
     try:
         url = f"https://www.showroom-live.com/api/live/live_info?room_id={room_id}"
-        res = requests.get(url, headers=headers, timeout=5).json()
+        res = api_get(url).json()
         host = res.get("bcsvr_host")
         key = res.get("bcsvr_key")
         if host and key:
-            return {"host": host, "key": key}
+            # live_id はジャーナル（event_store.py）で配信を区別するのに使う
+            return {"host": host, "key": key, "live_id": res.get("live_id")}
     except Exception as e:
         print(f"API Error (live_info): {e}")
     return None
 
-def update_free_gift_master(room_id):
-    headers = {
-        "User-Agent": "Mozilla/5.0",
-    }
-    try:
-        url = f"https://www.showroom-live.com/api/live/gift_list?room_id={room_id}"
-        res = requests.get(url, headers=headers, timeout=5).json()
-        master = {}
-        for cat_key in res.keys():
-            category_list = res[cat_key]
-            if isinstance(category_list, list):
-                for category in category_list:
-                    gifts = category.get("list", [])
-                    for gift in gifts:
-                        if gift.get("free") == True and gift.get("point") == 1:
-                            master[str(gift["gift_id"])] = {
-                                "name": gift["gift_name"],
-                                "image": gift["image"],
-                                "point": 1
-                            }
-        st.session_state.free_gift_master = master
-    except Exception as e:
-        print(f"API Error (gift_list): {e}")
-        if "free_gift_master" not in st.session_state:
-            st.session_state.free_gift_master = {}
\ No newline at end of file
+def build_log_entry(raw_data, free_gift_master):
+    """
+    キューから取り出した生データをログ用の辞書に変換する。
+    戻り値: ("system_msg", entry) / ("free_gift", entry) / (None, None)
+    """
+    # t の判定（文字列に変換して比較するのが最も安全です）
+    m_type = str(raw_data.get("t", ""))
+
+    # --- ✅ A. システムメッセージ (t: 18) の処理 ---
+    if m_type == "18":
+        # time.time() は使わず、datetime で安全にタイムスタンプを取得
+        ts = raw_data.get("created_at") or int(datetime.datetime.now().timestamp())
+        return "system_msg", {
+            "created_at": ts,
+            "message": raw_data.get("m", ""),
+            "user_id": raw_data.get("u")
+        }
+
+    # --- 🎁 B. 無償ギフト (t: 2) の処理 ---
+    if m_type == "2":
+        g_id = raw_data.get("g")
+        if g_id is None:
+            return None, None
+
+        # IDが数値でも文字列でも見つけられるように検索
+        gift_info = free_gift_master.get(str(g_id)) or free_gift_master.get(g_id)
+        if not gift_info:
+            # マスターにない（有償ギフトなど）場合はスキップ
+            return None, None
+
+        ts = raw_data.get("created_at") or int(datetime.datetime.now().timestamp())
+        return "free_gift", {
+            "created_at": ts,
+            "user_id": raw_data.get("u"),
+            "name": raw_data.get("ac"),
+            "avatar_id": raw_data.get("av"),
+            "gift_id": str(g_id),
+            "gift_name": gift_info.get("name"),
+            "point": gift_info.get("point", 1),
+            "num": raw_data.get("n", 1),
+            "image": gift_info.get("image", "")
+        }
+
+    return None, None
+
+
+def ingest_raw_batch(raw_items, free_gift_master, free_gift_log, system_msg_log):
+    """まとめて取り出した生データをログに変換し、無償ギフト・システムMSGのログへ受信順に追加する"""
+    for raw_data in raw_items:
+        try:
+            kind, entry = build_log_entry(raw_data, free_gift_master)
+            if kind == "system_msg":
+                system_msg_log.add(entry)
+            elif kind == "free_gift":
+                free_gift_log.add(entry)
+        except Exception as e:
+            # 1件の不正なデータで残りを取りこぼさないよう、出力だけして続ける
+            print(f"Loop Error: {e}")
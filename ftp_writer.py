@@ -0,0 +1,532 @@
+import contextlib
+import datetime
+import ftplib
+import io
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+import pandas as pd
+import streamlit as st
+from showroom_api import JST, JST_TIME_FORMAT, gift_fields, report, row_time
+
+# 索引ファイルのロック（collector.py と app.py が同じ索引を使う場合用）。fcntl が無い環境ではロックしない
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# --- FTP保存まわり（app.py / collector.py 共通） ---
+
+FTP_LOG_DIR = "/rokudouji.net/mksoul/showroom_onlives_logs"
+
+
+# アップロード待ちの上限件数（超えた分は保存せずにエラー表示）と、一時的な失敗のリトライ回数
+FTP_QUEUE_MAXSIZE = 200
+FTP_MAX_RETRIES = 3
+# 保存に失敗したファイルを画面に表示するため覚えておく件数（古いものから忘れる）
+FTP_FAILURE_HISTORY = 100
+# この秒数アップロードが無ければ接続を閉じる（次のアップロード時に張り直す）
+FTP_IDLE_CLOSE_SEC = 60
+# 保存期間（48時間）を過ぎたファイルを削除する間隔。アップロードのたびには行わない
+FTP_RETENTION_SEC = 48 * 3600
+FTP_SWEEP_INTERVAL = 3600
+# アップロード済みファイルと時刻の索引（追記のみ。削除時に詰め直す）
+FTP_INDEX_PATH = os.environ.get("SR_FTP_INDEX", "ftp_upload_index.tsv")
+# ファイル名末尾の「_YYYYmmdd_HHMMSS.csv」または「.parquet」（日本時間）
+FILENAME_TIME_PATTERN = re.compile(r"_(\d{8}_\d{6})\.(?:csv|parquet)$")
+
+
+class UploadIndex:
+    """
+    アップロード済みファイル名 -> アップロード時刻(epoch) の索引。
+    アップロード時は1行追記するだけなので、FTP上のファイル数に関係なく O(1)。
+    索引が無い状態で起動した場合（初回のみ）は、FTP上の一覧から作る（seeded=False）。
+    複数のプロセスが同じ索引を使えるよう、追記と書き直しはファイルロックの中で行い、
+    書き直しの前にはファイルを読み直して他のプロセスが追記した行を残す。
+    """
+
+    def __init__(self, path=FTP_INDEX_PATH):
+        self.path = path
+        self.files = {}
+        self.seeded = False
+        self.load()
+
+    @contextlib.contextmanager
+    def locked(self):
+        with open(f"{self.path}.lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def read(self):
+        """索引ファイルの中身 (files, seeded)"""
+        files = {}
+        seeded = False
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    line = line.rstrip("\n")
+                    if line == "#seeded":
+                        seeded = True
+                    elif "\t" in line:
+                        name, ts = line.rsplit("\t", 1)
+                        try:
+                            files[name] = float(ts)
+                        except ValueError:
+                            pass
+        except OSError:
+            pass
+        return files, seeded
+
+    def load(self):
+        self.files, self.seeded = self.read()
+
+    def add(self, name, uploaded_at):
+        self.files[name] = uploaded_at
+        with self.locked():
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(f"{name}\t{uploaded_at}\n")
+
+    def expired(self, now):
+        return [name for name, ts in self.files.items() if now - ts > FTP_RETENTION_SEC]
+
+    def rewrite(self, removed=()):
+        """
+        ファイル上の索引（他のプロセスの追記分を含む）とこのプロセスの索引を合わせ、
+        removed（削除済みのファイル）を除いて書き直す
+        """
+        with self.locked():
+            files, seeded = self.read()
+            files.update(self.files)
+            for name in removed:
+                files.pop(name, None)
+            self.files = files
+            self.seeded = self.seeded or seeded
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                if self.seeded:
+                    f.write("#seeded\n")
+                for name, ts in self.files.items():
+                    f.write(f"{name}\t{ts}\n")
+            os.replace(tmp_path, self.path)
+
+
+def parse_uploaded_at(name):
+    """ファイル名の日時（日本時間）を epoch に変換する。形式が違う場合は None"""
+    match = FILENAME_TIME_PATTERN.search(name)
+    if not match:
+        return None
+    try:
+        return JST.localize(datetime.datetime.strptime(match.group(1), "%Y%m%d_%H%M%S")).timestamp()
+    except ValueError:
+        return None
+
+
+class FtpUploader:
+    """
+    FTPへのアップロードを専用スレッドで順に処理する（全セッション・全ルームで共有）。
+    接続は使い回し、切断やタイムアウト等の一時的な失敗は接続し直してリトライする。
+    最終的に保存できなかったファイルは failures（ファイル名 -> エラー）に記録し、画面に表示する。
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=FTP_QUEUE_MAXSIZE)
+        self.ftp = None
+        self.index = UploadIndex()
+        self.next_sweep_at = 0
+        self.thread = None
+        self.lock = threading.Lock()
+        self.failures = OrderedDict()
+
+    def submit(self, filename, buf):
+        """アップロードを予約する。キューが満杯の場合は False"""
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        try:
+            self.queue.put_nowait((filename, buf))
+            return True
+        except queue.Full:
+            return False
+
+    def join(self):
+        """予約済みのアップロードがすべて終わるまで待つ（collector.py の終了時用）"""
+        self.queue.join()
+
+    def run(self):
+        while True:
+            try:
+                filename, buf = self.queue.get(timeout=FTP_IDLE_CLOSE_SEC)
+            except queue.Empty:
+                self.sweep_if_due()
+                self.close()
+                continue
+            try:
+                self.upload(filename, buf)
+                self.sweep_if_due()
+            finally:
+                self.queue.task_done()
+
+    def connect(self):
+        ftp_info = st.secrets["ftp"]
+        ftp = ftplib.FTP(ftp_info["host"], timeout=30)
+        ftp.login(ftp_info["user"], ftp_info["password"])
+        ftp.cwd(FTP_LOG_DIR)
+        return ftp
+
+    def close(self):
+        if self.ftp is not None:
+            try:
+                self.ftp.quit()
+            except Exception:
+                pass
+            self.ftp = None
+
+    def upload(self, filename, buf):
+        for attempt in range(FTP_MAX_RETRIES):
+            try:
+                if self.ftp is None:
+                    self.ftp = self.connect()
+                # アップロード
+                buf.seek(0)
+                self.ftp.storbinary(f"STOR {filename}", buf)
+                self.index.add(filename, time.time())
+                with self.lock:
+                    self.failures.pop(filename, None)
+                print(f"✅ FTPに保存完了: {filename}")
+                return
+            except ftplib.error_perm as e:
+                # 権限・ファイル名等の恒久的なエラーはリトライしない
+                print(f"FTP保存中にエラー: {filename}: {e}")
+                self.close()
+                self.record_failure(filename, e)
+                return
+            except Exception as e:
+                print(f"FTP保存中にエラー（{attempt + 1}/{FTP_MAX_RETRIES}回目）: {filename}: {e}")
+                self.close()
+                if attempt + 1 < FTP_MAX_RETRIES:
+                    time.sleep(2 ** attempt)
+                else:
+                    self.record_failure(filename, e)
+
+    def record_failure(self, filename, error):
+        with self.lock:
+            self.failures[filename] = str(error)
+            self.failures.move_to_end(filename)
+            if len(self.failures) > FTP_FAILURE_HISTORY:
+                self.failures.popitem(last=False)
+
+    def failures_for(self, room_id):
+        """ルームの保存に失敗したファイル名とエラー（古い順）。ファイル名に「_{room_id}_」を含むものを返す"""
+        with self.lock:
+            return [(name, error) for name, error in self.failures.items() if f"_{room_id}_" in name]
+
+    def sweep_if_due(self):
+        """FTP_SWEEP_INTERVAL ごとに、索引上で保存期間を過ぎたファイルを削除する（一覧の全件走査はしない）"""
+        now = time.time()
+        if now < self.next_sweep_at:
+            return
+        self.next_sweep_at = now + FTP_SWEEP_INTERVAL
+        try:
+            if self.ftp is None:
+                self.ftp = self.connect()
+            if not self.index.seeded:
+                self.seed_index()
+            expired = self.index.expired(now)
+            for name in expired:
+                try:
+                    self.ftp.delete(name)
+                except ftplib.error_perm:
+                    # 既に削除されている場合など
+                    pass
+            if expired:
+                self.index.rewrite(expired)
+        except Exception as e:
+            print(f"FTP古いファイル削除中にエラー: {e}")
+            self.close()
+
+    def seed_index(self):
+        """索引が無い場合に一度だけ、FTP上の既存ファイルから索引を作る"""
+        for name in self.ftp.nlst():
+            name = name.rsplit("/", 1)[-1]
+            uploaded_at = parse_uploaded_at(name)
+            if uploaded_at is not None:
+                self.index.files.setdefault(name, uploaded_at)
+        self.index.seeded = True
+        self.index.rewrite()
+
+
+# プロセス内で共有する実体
+ftp_uploader = FtpUploader()
+
+
+def upload_csv_to_ftp(filename: str, csv_buffer: io.BytesIO):
+    """
+    Secretsに登録されたFTP設定を使ってCSVをアップロード（バックグラウンドで実行され、呼び出し側は待たない）。
+    予約できたかを返す（キューが満杯なら False）
+    """
+    if ftp_uploader.submit(filename, csv_buffer):
+        report("success", f"✅ FTP保存を受け付けました: {filename}")
+        return True
+    report("error", f"FTP保存待ちが多すぎるため保存できませんでした: {filename}")
+    return False
+
+
+# --- ▼ 自動保存・最終保存用のCSV組み立て ▼ ---
+# 時間は取り込み時に計算済みの文字列（row_time）を使い、行ごとに pytz で変換し直さない
+
+def build_comment_df(comment_log):
+    return pd.DataFrame([
+        {
+            "コメント時間": row_time(log),
+            "ユーザー名": log.get("name", ""),
+            "コメント内容": log.get("comment", ""),
+            "ユーザーID": log.get("user_id", "")
+        }
+        # システムコメントは取り込み時に CommentLog.system_comments へ振り分け済み
+        for log in comment_log
+    ])
+
+
+def build_gift_df(gift_log, gift_list_map):
+    rows = []
+    for log in gift_log:
+        # ギフト名・ポイントは取り込み時に付与済み（付いていない行だけ gift_list_map から引く）
+        gift_name, point, _ = gift_fields(log, gift_list_map)
+        rows.append({
+            "ギフト時間": row_time(log),
+            "ユーザー名": log.get("name", ""),
+            "ギフト名": gift_name or "",
+            "個数": log.get("num", ""),
+            "ポイント": point,
+            "ユーザーID": log.get("user_id", "")
+        })
+    return pd.DataFrame(rows)
+
+
+def build_free_gift_df(free_gift_log):
+    return pd.DataFrame([
+        {
+            "ギフト時間": row_time(log),
+            "ユーザー名": log.get("name", ""),
+            "ギフト名": log.get("gift_name", ""),
+            "個数": log.get("num", ""),
+            "ポイント": log.get("point", 0),
+            "ユーザーID": log.get("user_id", "")
+        }
+        for log in free_gift_log
+    ])
+
+
+def build_system_msg_df(system_msg_log):
+    return pd.DataFrame([
+        {
+            "時間": row_time(log),
+            "メッセージ": log.get("message", ""),
+            "ユーザーID": log.get("user_id", "")
+        }
+        for log in system_msg_log
+    ])
+
+
+# --- ▼ 列指向フォーマット（Parquet） ▼ ---
+# CSVと同じ表を、時間は日本時間の日時型、ID・個数・ポイントは整数型のまま圧縮して保存する。
+# 分析側でCSVを文字列から読み直すより読み込みが速く、ファイルも小さい。
+# pyarrow（streamlit の依存に含まれる）が無い環境ではCSVのみ保存する。
+
+EXPORT_PARQUET = os.environ.get("SR_EXPORT_PARQUET", "1") != "0"
+PARQUET_COMPRESSION = "zstd"
+INTEGER_COLUMNS = ["ユーザーID", "個数", "合計個数", "ポイント", "合計Pt（※単純合計値）", "ギフト単位Pt", "順位", "レベル", "件数"]
+
+
+def to_typed_df(df):
+    """CSV用の表（時間は文字列）を、時間は日時型・数値列は整数型（欠損可）に変換する"""
+    typed = df.copy()
+    for column in typed.columns:
+        if column.endswith("時間"):
+            typed[column] = pd.to_datetime(typed[column], format=JST_TIME_FORMAT, errors="coerce").dt.tz_localize(JST)
+        elif column in INTEGER_COLUMNS:
+            typed[column] = pd.to_numeric(typed[column], errors="coerce").astype("Int64")
+    return typed
+
+
+def df_to_parquet_bytes(df):
+    """型付きの Parquet にする。pyarrow が無い場合は ImportError"""
+    buf = io.BytesIO()
+    to_typed_df(df).to_parquet(buf, index=False, compression=PARQUET_COMPRESSION)
+    return buf.getvalue()
+
+
+def upload_named_df_to_ftp(filename, df, parquet=EXPORT_PARQUET):
+    """
+    DataFrameを utf-8-sig のCSVにして filename でアップロード（parquet=True なら同名の .parquet も）。
+    CSVのアップロードを予約できたかを返す
+    """
+    buf = io.BytesIO()
+    df.to_csv(buf, index=False, encoding="utf-8-sig")
+    if not upload_csv_to_ftp(filename, buf):
+        return False
+    if parquet and filename.endswith(".csv"):
+        try:
+            upload_csv_to_ftp(f"{filename[:-4]}.parquet", io.BytesIO(df_to_parquet_bytes(df)))
+        except ImportError as e:
+            print(f"Parquet保存をスキップしました: {e}")
+    return True
+
+
+# --- ▼ 差分（セグメント）保存 ▼ ---
+# 100件ごとの自動保存で毎回全件を出し直すと、配信全体の転送量が件数の2乗で増える。
+# 前回保存以降に増えた行だけを「{prefix}_{room_id}_partNNNN_{開始日時}.csv」として保存し、
+# セグメントの一覧を「{prefix}_{room_id}_manifest_{開始日時}.csv」に書く。
+# 配信終了時（finish）には従来どおりの全件ファイル「{prefix}_{room_id}_{終了日時}.csv」を1つ保存する。
+# 全件ファイルは基本的にメモリ上のログから作り、max_rows で古い行を捨てたログだけは
+# EXPORT_SPOOL_DIR に控えておいたセグメントを stitch_segments でつなげて作る（作った後に控えを消す）。
+
+SEGMENT_ROWS = 100
+EXPORT_SPOOL_DIR = os.environ.get("SR_EXPORT_SPOOL_DIR", "export_spool")
+# finish() まで行かなかった配信（タブを閉じた・停止ボタン等）の控えは、ジャーナルと同じく48時間で消す
+EXPORT_SPOOL_RETENTION_SEC = 48 * 3600
+
+
+class SegmentedExport:
+    """1ルーム・1種類のログの差分保存の状態（トラッキング開始ごとに作り直す）"""
+
+    def __init__(self, prefix, room_id, build_df):
+        self.prefix = prefix
+        self.room_id = room_id
+        # 行のリストから保存用の DataFrame を作る関数（build_comment_df 等）
+        self.build_df = build_df
+        self.started = datetime.datetime.now(JST).strftime("%Y%m%d_%H%M%S")
+        self.exported = 0
+        self.next_threshold = SEGMENT_ROWS
+        # (ファイル名, 件数) のリスト
+        self.segments = []
+        # finish() で全件ファイルを保存済みか（配信終了後の再実行で何度も保存しない）
+        self.finished = False
+
+    def checkpoint_if_due(self, log):
+        """ログが次の100の倍数に達していたら、前回以降の追加分を保存する"""
+        if log.added >= self.next_threshold:
+            self.checkpoint(log)
+            self.next_threshold = (log.added // SEGMENT_ROWS + 1) * SEGMENT_ROWS
+
+    def checkpoint(self, log):
+        """前回以降に追加された行があれば、1セグメントとして保存しマニフェストを更新する"""
+        new_rows = log.since(self.exported)
+        if not new_rows:
+            return
+        # 全件保存と同じく新しい順で書き出す
+        df = self.build_df(new_rows[::-1])
+        if not df.empty:
+            filename = f"{self.prefix}_{self.room_id}_part{len(self.segments) + 1:04d}_{self.started}.csv"
+            if not upload_named_df_to_ftp(filename, df):
+                # 予約できなかった行は保存済みにせず、次のセグメントに含めて保存し直す
+                return
+        self.exported = log.added
+        self.track(log)
+        if df.empty:
+            # システムコメントのみ等で保存対象が無い場合
+            return
+        self.segments.append((filename, len(df)))
+        manifest = pd.DataFrame(self.segments, columns=["セグメント", "件数"])
+        # マニフェストはCSVのみ（各セグメントの .parquet は同じ名前で拡張子だけ異なる）
+        upload_named_df_to_ftp(self.manifest_name(), manifest, parquet=False)
+        self.spool(filename, df, manifest)
+
+    def track(self, log):
+        """保存済みの位置をログに伝え、まだ保存していない行が max_rows で捨てられないようにする"""
+        log.keep_from = self.exported
+
+    def manifest_name(self):
+        return f"{self.prefix}_{self.room_id}_manifest_{self.started}.csv"
+
+    def spool(self, filename, df, manifest):
+        """配信終了時に全件ファイルを作るため、セグメントとマニフェストを手元にも書いておく"""
+        try:
+            os.makedirs(EXPORT_SPOOL_DIR, exist_ok=True)
+            df.to_csv(os.path.join(EXPORT_SPOOL_DIR, filename), index=False, encoding="utf-8-sig")
+            manifest.to_csv(os.path.join(EXPORT_SPOOL_DIR, self.manifest_name()), index=False, encoding="utf-8-sig")
+        except OSError as e:
+            print(f"セグメントの控えを書けませんでした: {e}")
+
+    def finish(self, log):
+        """
+        配信終了時の最終保存。未保存分を最後のセグメントとして保存し、
+        全件ファイルを1つ保存して、手元の控えを消す（全件ファイルの保存は1回だけ）
+        """
+        self.checkpoint(log)
+        if self.finished or not self.segments:
+            return
+        self.finished = True
+        if log.base == 0:
+            # 捨てた行が無ければ、従来どおりメモリ上のログ（新しい順）から作る
+            df = self.build_df(list(log))
+        else:
+            manifest_path = os.path.join(EXPORT_SPOOL_DIR, self.manifest_name())
+            try:
+                df = stitch_segments(manifest_path)
+            except (OSError, ValueError) as e:
+                print(f"セグメントをつなげられませんでした（各セグメントは保存済み）: {e}")
+                return
+        timestamp = datetime.datetime.now(JST).strftime("%Y%m%d_%H%M%S")
+        upload_named_df_to_ftp(f"{self.prefix}_{self.room_id}_{timestamp}.csv", df)
+        for name in [self.manifest_name(), *(filename for filename, _ in self.segments)]:
+            try:
+                os.remove(os.path.join(EXPORT_SPOOL_DIR, name))
+            except OSError:
+                pass
+
+
+def create_segmented_exports(room_id, get_gift_list_map, logs):
+    """
+    ログ種類ごとの差分保存の状態を作る。get_gift_list_map は保存時点のギフトリストを返す関数、
+    logs は open_room_logs() が返したログ（まだ保存していない行を捨てないよう、ここで紐付ける）
+    """
+    exports = {
+        "comment": SegmentedExport("comment_log", room_id, build_comment_df),
+        "gift": SegmentedExport("gift_log", room_id, lambda rows: build_gift_df(rows, get_gift_list_map())),
+        "free_gift": SegmentedExport("free_gift_log", room_id, build_free_gift_df),
+        "system_msg": SegmentedExport("system_msg_log", room_id, build_system_msg_df),
+    }
+    for log_type, exporter in exports.items():
+        exporter.track(logs[log_type])
+    remove_expired_spool()
+    return exports
+
+
+def remove_expired_spool():
+    """EXPORT_SPOOL_RETENTION_SEC より古いセグメントの控えを消す"""
+    cutoff = time.time() - EXPORT_SPOOL_RETENTION_SEC
+    try:
+        names = os.listdir(EXPORT_SPOOL_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(EXPORT_SPOOL_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def stitch_segments(manifest_path):
+    """
+    ダウンロードしたマニフェストと同じフォルダにあるセグメントをつなげて、全件保存と同じ形の DataFrame を返す。
+    各セグメントは新しい順に書かれているので、新しいセグメントから順につなげる（時間では並べ直さない）。
+    値は書かれたとおりの文字列のまま読む（"None" や "007" を欠損値・数値に変えない）
+    """
+    folder = os.path.dirname(manifest_path)
+    manifest = pd.read_csv(manifest_path, encoding="utf-8-sig", dtype=str, keep_default_na=False)
+    parts = [
+        pd.read_csv(os.path.join(folder, name), encoding="utf-8-sig", dtype=str, keep_default_na=False)
+        for name in reversed(list(manifest["セグメント"]))
+    ]
+    if not parts:
+        return pd.DataFrame()
+    return pd.concat(parts, ignore_index=True)
+
@@ -0,0 +1,475 @@
+import datetime
+import functools
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import time
+import requests
+import pytz
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# --- app.py（Streamlit画面）と collector.py（ヘッドレス収集）で共有するAPI連携部分 ---
+
+# 定数
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "Accept-Language": "ja-JP,ja;q=0.9,en-US;q=0.8,en;q=0.7",
+}
+JST = pytz.timezone('Asia/Tokyo')
+ONLIVES_API_URL = "https://www.showroom-live.com/api/live/onlives"
+COMMENT_API_URL = "https://www.showroom-live.com/api/live/comment_log"
+GIFT_API_URL = "https://www.showroom-live.com/api/live/gift_log"
+GIFT_LIST_API_URL = "https://www.showroom-live.com/api/live/gift_list"
+FAN_LIST_API_URL = "https://www.showroom-live.com/api/active_fan/users"
+SYSTEM_COMMENT_KEYWORDS = ["SHOWROOM Management", "Earn weekly glittery rewards!", "ウィークリーグリッター特典獲得中！", "SHOWROOM運営"]
+# キーワードのどれかを含むかを1回の検索で判定する
+SYSTEM_COMMENT_PATTERN = re.compile("|".join(re.escape(keyword) for keyword in SYSTEM_COMMENT_KEYWORDS))
+
+
+def is_system_comment(row):
+    """ユーザー名またはコメント本文に SYSTEM_COMMENT_KEYWORDS を含む運営・システムのコメントか"""
+    return bool(SYSTEM_COMMENT_PATTERN.search(row.get("name") or "") or SYSTEM_COMMENT_PATTERN.search(row.get("comment") or ""))
+
+# --- 日本時間の表示用文字列 ---
+# 日本時間には夏時間が無いので、pytz を通さず UTC+9 の固定オフセットで変換する。
+# 同じ秒のイベントが多いので、変換結果は秒単位でキャッシュする（約18時間分）
+JST_OFFSET_SEC = 9 * 3600
+JST_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+@functools.lru_cache(maxsize=65536)
+def format_jst(ts, fmt=JST_TIME_FORMAT):
+    """epoch 秒を日本時間の文字列にする"""
+    return time.strftime(fmt, time.gmtime(int(ts) + JST_OFFSET_SEC))
+
+
+def row_time(row):
+    """ログ1行の日本時間（"%Y-%m-%d %H:%M:%S"）。取り込み時に計算済みの "time" があればそれを使う"""
+    return row.get("time") or format_jst(row.get("created_at") or 0)
+
+# --- 共有HTTPセッション（keep-aliveで接続を使い回し、TLSハンドシャイクを毎回行わない） ---
+HTTP_TIMEOUT = 5
+# ホストごとに保持・同時使用する接続数の上限（超えた分は空くまで待つ）
+HTTP_POOL_MAXSIZE = 32
+HTTP_RETRY = Retry(
+    total=2,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET"],
+)
+
+
+def create_http_session():
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=HTTP_RETRY, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# プロセス内（全セッション・全スレッド）で共有する実体
+http_session = create_http_session()
+
+
+def api_get(url, **kwargs):
+    """SHOWROOM API への GET は必ずここを通す（共通のヘッダー・タイムアウト・リトライ）"""
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    return http_session.get(url, **kwargs)
+
+
+def report(level, message):
+    """Streamlit実行中なら画面に表示し、ヘッドレス実行（collector.py等）ではコンソールに出力する"""
+    if get_script_run_ctx() is not None:
+        getattr(st, level)(message)
+    else:
+        print(f"[{level}] {message}")
+
+
+def get_onlives_rooms():
+    onlives = {}
+    try:
+        response = api_get(ONLIVES_API_URL)
+        response.raise_for_status()
+        data = response.json()
+        all_lives = []
+        if isinstance(data, dict):
+            if 'onlives' in data and isinstance(data['onlives'], list):
+                for genre_group in data['onlives']:
+                    if 'lives' in genre_group and isinstance(genre_group['lives'], list):
+                        all_lives.extend(genre_group['lives'])
+            for live_type in ['official_lives', 'talent_lives', 'amateur_lives']:
+                if live_type in data and isinstance(data.get(live_type), list):
+                    all_lives.extend(data[live_type])
+        for room in all_lives:
+            room_id = None
+            if isinstance(room, dict):
+                room_id = room.get('room_id')
+                if room_id is None and 'live_info' in room and isinstance(room['live_info'], dict):
+                    room_id = room['live_info'].get('room_id')
+                if room_id is None and 'room' in room and isinstance(room['room'], dict):
+                    room_id = room['room'].get('room_id')
+            if room_id:
+                onlives[int(room_id)] = room
+    except requests.exceptions.RequestException as e:
+        report("error", f"配信情報取得中にエラーが発生しました: {e}")
+    except (ValueError, AttributeError):
+        report("error", "配信情報のJSONデコードまたは解析に失敗しました。")
+    return onlives
+
+
+# onlives スナップショットの有効期間（秒）と、参照が途絶えたらバックグラウンド更新を止めるまでの秒数
+ONLIVES_CACHE_TTL = 10
+ONLIVES_CACHE_IDLE_STOP = 300
+
+
+class OnlivesCache:
+    """
+    全セッション・全ルームで共有する onlives のスナップショット（room_id -> 配信情報）。
+    初回以外は読み取りで待たされず、バックグラウンドのスレッドが TTL ごとに1回だけ取得し直す。
+    取得はロックの外で行い、同時に取得し直すのは1スレッドだけ（API障害時に各セッションが順番に待たされない）。
+    """
+
+    def __init__(self, ttl=ONLIVES_CACHE_TTL):
+        self.ttl = ttl
+        self.index = {}
+        self.fetched_at = 0
+        self.last_read_at = 0
+        self.thread = None
+        self.lock = threading.Lock()
+        # 同期の取得中は threading.Event（完了で set される）、それ以外は None
+        self.refreshing = None
+
+    def get(self):
+        self.last_read_at = time.time()
+        with self.lock:
+            # 初回や長時間参照がなかった後（バックグラウンド更新が止まっている場合）は取得し直す
+            is_stale = time.time() - self.fetched_at > self.ttl * 3
+            is_leader = is_stale and self.refreshing is None
+            if is_leader:
+                self.refreshing = threading.Event()
+            refreshing = self.refreshing
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        if is_leader:
+            try:
+                self.refresh()
+            finally:
+                with self.lock:
+                    self.refreshing = None
+                refreshing.set()
+        elif is_stale and refreshing is not None and not self.index:
+            # まだ一度も取得できていない場合だけ、取得中の1回の完了を一緒に待つ（空を「全ルーム配信終了」と誤らない）
+            refreshing.wait()
+        # 古いスナップショットがあれば、取得中でもそれを返す
+        return self.index
+
+    def is_live(self, room_id):
+        """ルームが配信中か（スナップショットに含まれるか）"""
+        return int(room_id) in self.get()
+
+    def refresh(self):
+        index = get_onlives_rooms()
+        # 取得失敗（空）の場合は直前のスナップショットを使い続け、全ルームを配信終了扱いにしない
+        if index:
+            self.index = index
+            self.fetched_at = time.time()
+
+    def run(self):
+        while time.time() - self.last_read_at < ONLIVES_CACHE_IDLE_STOP:
+            time.sleep(self.ttl)
+            self.refresh()
+
+
+# プロセス内で共有する実体
+onlives_cache = OnlivesCache()
+
+
+def get_and_update_log(log_type, room_id, existing_cache):
+    """
+    コメント or ギフトログを取得し、既存のキャッシュ（event_store.RoomLog）にマージして返す。
+    existing_cache は画面側ではセッション状態、コレクター側ではルームごとの RoomLog を渡す。
+    """
+    api_url = COMMENT_API_URL if log_type == "comment" else GIFT_API_URL
+    url = f"{api_url}?room_id={room_id}"
+    try:
+        response = api_get(url)
+        response.raise_for_status()
+        new_log = response.json().get(f'{log_type}_log', [])
+        if log_type != "gift":
+            # 新着分だけを O(k) でマージ（全件のキー集合再構築・再ソートはしない）
+            existing_cache.merge(new_log)
+            return existing_cache
+
+        # スペシャルギフトは新着分にだけギフト名・ポイント・画像を付けてからマージする
+        gift_map = get_gift_list(room_id)
+        unknown_gift_ids = set()
+
+        def enrich(row):
+            if not enrich_gift_row(row, gift_map):
+                unknown_gift_ids.add(str(row.get("gift_id")))
+
+        existing_cache.merge(new_log, enrich)
+        # カタログに無いギフトはバックグラウンドで取り直す（次回以降の取り込みから付く）
+        if unknown_gift_ids:
+            gift_catalog_cache.request_unknown(room_id, unknown_gift_ids)
+        return existing_cache
+    except requests.exceptions.RequestException:
+        report("warning", f"ルームID {room_id} の{log_type}ログ取得中にエラーが発生しました。配信中か確認してください。")
+        return existing_cache
+
+
+def enrich_gift_row(row, gift_map):
+    """スペシャルギフトの行にギフトリストの名前・ポイント・画像を付ける。リストに無いギフトなら False"""
+    gift_info = gift_map.get(str(row.get("gift_id")))
+    if not gift_info:
+        return False
+    row["gift_name"] = gift_info.get("name")
+    row["point"] = gift_info.get("point", 0)
+    if not row.get("image"):
+        row["image"] = gift_info.get("image", "")
+    return True
+
+
+def gift_fields(row, gift_map):
+    """
+    スペシャルギフトの行の (ギフト名, ポイント, 画像)。取り込み時に付けた値を使い、
+    付いていない行（取り込み時にギフトリストに無かったギフト）だけ gift_map から引く。分からない名前は None
+    """
+    if row.get("gift_name") is not None:
+        return row["gift_name"], row.get("point") or 0, row.get("image", "")
+    gift_info = gift_map.get(str(row.get("gift_id")), {})
+    return gift_info.get("name"), gift_info.get("point", 0), row.get("image") or gift_info.get("image", "")
+
+
+# ギフトカタログの有効期間（秒）と、キャッシュしておくルーム数の上限（超えたら最も使われていないルームから捨てる）
+GIFT_CATALOG_TTL = 600
+GIFT_CATALOG_MAX_ROOMS = 500
+# カタログに無いギフトIDで取得し直した後、同じIDで再取得を許すまでの秒数（ネガティブキャッシュ）
+UNKNOWN_GIFT_RETRY_SEC = 300
+
+
+def parse_gift_catalog(data):
+    """gift_list APIの応答を1回走査し、全ギフトの map と無償ギフト(free=True, 1pt)の master を同時に作る"""
+    gift_map = {}
+    free_master = {}
+    # すべてのカテゴリ（normal, special, enquete, seasonal等）を網羅的に走査
+    for category_items in data.values():
+        if not isinstance(category_items, list):
+            continue
+        for gift in category_items:
+            gid = str(gift.get('gift_id'))
+            try:
+                p = int(gift.get('point', 0))
+            except (ValueError, TypeError):
+                p = 0
+
+            gift_map[gid] = {
+                'name': gift.get('gift_name', 'N/A'),
+                'point': p,
+                'image': gift.get('image', ''),
+                'free': gift.get('free', False)
+            }
+            # フリー かつ point が 1 のものだけを無償ギフトのマスターに登録する
+            if gift.get("free") == True and gift.get("point") == 1:
+                free_master[gid] = {
+                    "name": gift.get("gift_name"),
+                    "point": gift.get("point", 0),
+                    "image": gift.get("image")
+                }
+    return gift_map, free_master
+
+
+class RoomCache:
+    """
+    ルームごとの取得結果を全セッションで共有するキャッシュ（TTL＋LRU）。
+    TTL切れの値は古いまま返しつつバックグラウンドで取得し直すので、呼び出し側は待たされない。
+    サブクラスは fetch(room_id) で取得処理を実装し、失敗時は None を返す。
+    """
+
+    def __init__(self, ttl, max_rooms):
+        self.ttl = ttl
+        self.max_rooms = max_rooms
+        # room_id -> (取得時刻, 値)
+        self.entries = OrderedDict()
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def fetch(self, room_id):
+        raise NotImplementedError
+
+    def evicted(self, room_id):
+        """LRUで捨てられたルームの後始末（必要なサブクラスのみ実装）"""
+
+    def get(self, room_id, force_update=False):
+        """値を返す。一度も取得できていない場合は None"""
+        room_id = str(room_id)
+        with self.lock:
+            entry = self.entries.get(room_id)
+            if entry is not None:
+                self.entries.move_to_end(room_id)
+        if entry is None or force_update:
+            value = self.refresh(room_id)
+            return value if value is not None else (entry and entry[1])
+        if time.time() - entry[0] > self.ttl:
+            self.refresh_in_background(room_id)
+        return entry[1]
+
+    def refresh(self, room_id):
+        value = self.fetch(room_id)
+        if value is None:
+            return None
+        with self.lock:
+            self.entries[room_id] = (time.time(), value)
+            self.entries.move_to_end(room_id)
+            while len(self.entries) > self.max_rooms:
+                evicted_room_id, _ = self.entries.popitem(last=False)
+                self.evicted(evicted_room_id)
+        return value
+
+    def refresh_in_background(self, room_id):
+        with self.lock:
+            if room_id in self.refreshing:
+                return
+            self.refreshing.add(room_id)
+
+        def worker():
+            try:
+                self.refresh(room_id)
+            finally:
+                with self.lock:
+                    self.refreshing.discard(room_id)
+
+        threading.Thread(target=worker, daemon=True).start()
+
+
+class GiftCatalogCache(RoomCache):
+    """ルームごとのギフトカタログ (gift_map, free_master) の共有キャッシュ"""
+
+    def __init__(self, ttl=GIFT_CATALOG_TTL, max_rooms=GIFT_CATALOG_MAX_ROOMS):
+        super().__init__(ttl, max_rooms)
+        # room_id -> {カタログに無かった gift_id: 再取得を依頼した時刻}
+        self.unknown_ids = {}
+
+    def fetch(self, room_id):
+        url = f"{GIFT_LIST_API_URL}?room_id={room_id}"
+        try:
+            response = api_get(url)
+            response.raise_for_status()
+            return parse_gift_catalog(response.json())
+        except Exception as e:
+            print(f"Gift List API Error: {e}")
+            return None
+
+    def evicted(self, room_id):
+        self.unknown_ids.pop(room_id, None)
+
+    def request_unknown(self, room_id, gift_ids):
+        """
+        カタログに無いギフトIDを見つけたときに呼ぶ。未依頼のIDがあればバックグラウンドで1回だけ取得し直す。
+        一度依頼したIDは UNKNOWN_GIFT_RETRY_SEC の間は再依頼しない（廃止ギフト等で毎回取得しないため）
+        """
+        room_id = str(room_id)
+        now = time.time()
+        with self.lock:
+            requested = self.unknown_ids.setdefault(room_id, {})
+            new_ids = [gid for gid in gift_ids if now - requested.get(gid, 0) > UNKNOWN_GIFT_RETRY_SEC]
+            for gid in new_ids:
+                requested[gid] = now
+        if new_ids:
+            self.refresh_in_background(room_id)
+
+
+# プロセス内で共有する実体
+gift_catalog_cache = GiftCatalogCache()
+
+
+def get_gift_list(room_id, force_update=False):
+    """
+    ギフトリスト（gift_id -> name/point/image/free）を共有キャッシュから返す。
+    force_update=True の場合は取得し直す。取得できない場合は空の dict
+    """
+    catalog = gift_catalog_cache.get(room_id, force_update)
+    return catalog[0] if catalog else {}
+
+
+def get_free_gift_master(room_id):
+    """無償ギフト(free=True)のマスターを共有キャッシュから返す。取得失敗時は None"""
+    catalog = gift_catalog_cache.get(room_id)
+    if not catalog:
+        report("error", "ギフトリストの取得に失敗しました。")
+        return None
+    return catalog[1]
+
+
+# ファンリストはダッシュボードの更新（10秒）より遅い周期で取り直す
+FAN_LIST_TTL = 60
+FAN_LIST_MAX_ROOMS = 500
+FAN_LIST_PAGE_SIZE = 50
+# total_user_count が分かった後、同時に取得するページ数
+FAN_LIST_PARALLEL_PAGES = 4
+# この値未満のレベルが出てきた時点で打ち切る
+FAN_LIST_MIN_LEVEL = 10
+
+
+def fetch_fan_page(room_id, ym, offset):
+    url = f"{FAN_LIST_API_URL}?room_id={room_id}&ym={ym}&offset={offset}&limit={FAN_LIST_PAGE_SIZE}"
+    response = api_get(url)
+    response.raise_for_status()
+    return response.json()
+
+
+def fetch_fan_list(room_id):
+    """
+    レベル10以上のファンを取得して (fan_list, total_user_count) を返す。取得失敗時は None。
+    1ページ目で total_user_count が分かったら、残りのページを FAN_LIST_PARALLEL_PAGES 件ずつ並列に取得し、
+    レベル10未満が出たところで打ち切る。
+    """
+    current_ym = datetime.datetime.now(JST).strftime("%Y%m")
+    fan_list = []
+    try:
+        data = fetch_fan_page(room_id, current_ym, 0)
+        total_user_count = data.get("total_user_count", 0)
+        pages = [data.get("users", [])]
+        next_offset = FAN_LIST_PAGE_SIZE
+        with ThreadPoolExecutor(max_workers=FAN_LIST_PARALLEL_PAGES) as pool:
+            while pages:
+                for users in pages:
+                    for user in users:
+                        if user.get('level', 0) < FAN_LIST_MIN_LEVEL:
+                            return fan_list, total_user_count
+                        fan_list.append(user)
+                    if len(users) < FAN_LIST_PAGE_SIZE:
+                        return fan_list, total_user_count
+                batch_end = next_offset + FAN_LIST_PAGE_SIZE * FAN_LIST_PARALLEL_PAGES
+                batch = [o for o in range(next_offset, batch_end, FAN_LIST_PAGE_SIZE) if not total_user_count or o < total_user_count]
+                next_offset = batch_end
+                pages = [page.get("users", []) for page in pool.map(lambda o: fetch_fan_page(room_id, current_ym, o), batch)]
+    except requests.exceptions.RequestException:
+        report("warning", f"ルームID {room_id} のファンリスト取得中にエラーが発生しました。")
+        return None
+    return fan_list, total_user_count
+
+
+class FanListCache(RoomCache):
+    """ルームごとのファンリスト (fan_list, total_user_count) の共有キャッシュ"""
+
+    def __init__(self, ttl=FAN_LIST_TTL, max_rooms=FAN_LIST_MAX_ROOMS):
+        super().__init__(ttl, max_rooms)
+
+    def fetch(self, room_id):
+        return fetch_fan_list(room_id)
+
+
+# プロセス内で共有する実体
+fan_list_cache = FanListCache()
+
+
+def get_fan_list(room_id):
+    """ファンリストを共有キャッシュから返す（FAN_LIST_TTL ごとにバックグラウンドで取り直す）"""
+    return fan_list_cache.get(room_id) or ([], 0)